@@ -1,3 +1,10 @@
+import typing as t
+import atexit
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
 from flask import (
     Flask,
     Response,
@@ -10,6 +17,10 @@ from flask import (
     send_file
 )
 
+from flask.json.provider import JSONProvider
+
+import orjson
+
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 
@@ -23,15 +34,89 @@ from .music_engine_utilities import VocalRange
 from .music_engine_utilities import MusicEngineUtilities
 from .music_engine import MusicEngine
 from .music_engine import ScoreState
+from .music_engine import TransposeUndo
+from .music_engine import ChordOptionUndo
+from .music_engine import VisibilityUndo
+from .music_engine import RestoreUndo
+from .music_engine import DoItem
 
 # Factory function.  flask knows how to find this (it has a standard
 # name) when passed music_site on the flask command line, e.g.
 #       flask --app music_site run --debug
 
+LOG_FORMAT: str = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+class _LazyQueueHandler(QueueHandler):
+    # A QueueHandler that starts its QueueListener (the thread that does the writing)
+    # when it is first given a record, not when app is imported.  Processes that
+    # import app but never log (e.g. the worker pools' forkserver, see
+    # routes.makeWorkerPool) then don't start a thread.
+    def __init__(self, listener: QueueListener) -> None:
+        super().__init__(listener.queue)
+        self.listener: QueueListener = listener
+        self.listenerStarted: bool = False
+        self.listenerLock = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if not self.listenerStarted:
+            with self.listenerLock:
+                if not self.listenerStarted:
+                    self.listener.start()
+                    atexit.register(self.listener.stop)
+                    self.listenerStarted = True
+        super().enqueue(record)
+
+def _setupLogging(level: str):
+    # Everything logged under 'app' (including app.logger) goes onto a queue, and
+    # a background thread (the QueueListener) does the actual (blocking) writing,
+    # so request threads never wait on stderr.
+    logQueue: queue.SimpleQueue = queue.SimpleQueue()
+    streamHandler = logging.StreamHandler()
+    streamHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    appLogger: logging.Logger = logging.getLogger(__name__)
+    appLogger.addHandler(_LazyQueueHandler(QueueListener(logQueue, streamHandler)))
+    appLogger.setLevel(level)
+    appLogger.propagate = False
+
+def setupWorkerLogging():
+    # ProcessPoolExecutor initializer for the worker pools (see routes.makeWorkerPool).
+    # Its workers are forked from a process that imported app, so they inherit the
+    # 'app' logger's queue handler, but not a thread to empty its queue.  They are
+    # single-threaded, so they just write to stderr themselves.
+    streamHandler = logging.StreamHandler()
+    streamHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    appLogger: logging.Logger = logging.getLogger(__name__)
+    for handler in list(appLogger.handlers):
+        appLogger.removeHandler(handler)
+    appLogger.addHandler(streamHandler)
+
+class OrjsonProvider(JSONProvider):
+    # Flask's JSON support (jsonify, dict results, request.get_json, etc), but done by
+    # orjson, which is several times faster than the stdlib json module (especially
+    # for our long, XML-filled strings).
+    def dumps(self, obj: t.Any, **kwargs: t.Any) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s: str | bytes, **kwargs: t.Any) -> t.Any:
+        return orjson.loads(s)
+
+    def response(self, *args: t.Any, **kwargs: t.Any) -> Response:
+        # skips the bytes -> str -> bytes round trip dumps() would do
+        obj: t.Any = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
 # create and configure the app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config.from_object(Config)
-db = SQLAlchemy(app)
+_setupLogging(app.config['LOG_LEVEL'])
+# expire_on_commit=False: objects stay usable after commit without being reloaded
+# from the database.  Requests commit once, at the very end (see
+# routes.commitDatabaseChanges), so reloading them would be wasted work.
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
 migrate = Migrate(app, db)
 
 from app import routes, models, commands  # pylint: disable=wrong-import-order
+app.register_blueprint(routes.bp)
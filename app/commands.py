@@ -1,115 +1,172 @@
 import typing as t
 # import zlib
-
-import music21 as m21
+import io
+import pickle
+import sys
+import uuid
 
 import sqlalchemy as sa
 
-# import click  # for @click.argument('name') or whatever
+import click
 from flask.cli import AppGroup
 
 from app import app, db
 from app import MusicEngine, MusicEngineUtilities, ScoreState, PartName, VocalRange, ArrangementType
+from app import RestoreUndo, DoItem
 from app.models import AnonymousSession
 
+if t.TYPE_CHECKING:
+    # only needed for annotations
+    import music21 as m21
+
 gdb_cli = AppGroup('gdb')
 app.cli.add_command(gdb_cli)
 
 @gdb_cli.command('dump')
-def dump():
-    # flask gdb dump
-    query = sa.select(AnonymousSession)
-    sessions = db.session.scalars(query).all()
-    for s in sessions:
-        print(f'------------{s.sessionUUID}------------')
-        printFrozenMusicEngine(s.musicEngine)
-        printZippedMeiFile(s.mei)
-        printZippedHumdrumFile(s.humdrum)
-        printZippedMusicXmlFile(s.musicxml)
-
-def printFrozenMusicEngine(frozenMe: bytes | None):
+@click.option('--verbose', is_flag=True, help='Thaw each music engine and print all of it.')
+def dump(verbose: bool):
+    # flask gdb dump [--verbose]
+    # Only scan the primary keys (and the sizes of the big columns); each big
+    # column is then loaded on its own, only if there's something in it.
+    # Note that this list is fetched all at once (it's small), rather than streamed,
+    # because some database drivers can't run the per-session queries while a
+    # streamed result is still pending.
+    query = sa.select(
+        AnonymousSession.sessionUUID,
+        AnonymousSession.scoreLabel,
+        sa.func.length(AnonymousSession.musicEngine),
+        sa.func.length(AnonymousSession.renderings)
+    )
+    rows = db.session.execute(query).all()
+    for sessionUUID, scoreLabel, musicEngineLength, renderingsLength in rows:
+        # buffer up each session's output, and write it all at once
+        buf = io.StringIO()
+        print(f'------------{sessionUUID}------------', file=buf)
+        if verbose or (scoreLabel is None and musicEngineLength):
+            # (sessions stored before scoreLabel existed have to be thawed)
+            printFrozenMusicEngine(
+                loadSessionColumn(sessionUUID, AnonymousSession.musicEngine, musicEngineLength),
+                file=buf
+            )
+        else:
+            printMusicEngineSummary(scoreLabel, musicEngineLength, file=buf)
+        printRenderings(
+            loadSessionColumn(sessionUUID, AnonymousSession.renderings, renderingsLength),
+            file=buf
+        )
+        sys.stdout.write(buf.getvalue())
+
+def loadSessionColumn(
+    sessionUUID: uuid.UUID,
+    column: t.Any,
+    length: int | None
+) -> bytes | None:
+    # loads a single column from a single session (length is the column's
+    # length, so we can skip the query if it is NULL or empty)
+    if length is None:
+        return None
+    if length == 0:
+        return b''
+    query = sa.select(column).where(AnonymousSession.sessionUUID == sessionUUID)
+    return db.session.scalar(query)
+
+def printMusicEngineSummary(
+    scoreLabel: str | None,
+    musicEngineLength: int | None,
+    file: t.TextIO | None = None
+):
+    if musicEngineLength is None:
+        print('musicEngine: None.', file=file)
+        return
+    if musicEngineLength == 0:
+        print('musicEngine: empty bytes.', file=file)
+        return
+    print(f'musicEngine (frozen length = {musicEngineLength}): {scoreLabel}', file=file)
+
+def printFrozenMusicEngine(frozenMe: bytes | None, file: t.TextIO | None = None):
     if frozenMe is None:
-        print('musicEngine: None.')
+        print('musicEngine: None.', file=file)
         return
     if frozenMe == b'':
-        print('musicEngine: empty bytes.')
+        print('musicEngine: empty bytes.', file=file)
         return
 
-    try:
-        me: MusicEngine = MusicEngine.thaw(frozenMe)
-    except Exception as e:
-        print(f'musicEngine: unthawable. {e}')
-        return
+    me: MusicEngine
+    header: dict[str, t.Any] | None = MusicEngine.peek(frozenMe)
+    if header is not None and not header['hasScore']:
+        # no score means nothing else is stored either, no need to thaw it
+        me = MusicEngine()
+    else:
+        try:
+            me = MusicEngine.thaw(frozenMe)
+        except Exception as e:
+            print(f'musicEngine: unthawable. {e}', file=file)
+            return
 
-    print(f'musicEngine (frozen length = {len(frozenMe)}):')
+    print(f'musicEngine (frozen length = {len(frozenMe)}):', file=file)
     if me.m21Score is None:
-        print('    m21Score: None.')
+        print('    m21Score: None.', file=file)
     else:
-        print(f'    m21Score: {scoreString(me.m21Score)}')
-    print('    scoreState:')
-    print(f'        shoppedAs: {shoppedAsString(me.scoreState.shoppedAs)}')
-    print(f'        shoppedPartRanges: {partRangesString(me.scoreState.shoppedPartRanges)}')
+        print(f'    m21Score: {MusicEngineUtilities.scoreLabel(me.m21Score)}', file=file)
+    print('    scoreState:', file=file)
+    print(f'        shoppedAs: {shoppedAsString(me.scoreState.shoppedAs)}', file=file)
+    print(
+        f'        shoppedPartRanges: {partRangesString(me.scoreState.shoppedPartRanges)}',
+        file=file
+    )
     if not me.undoList:
-        print('    undoList: empty')
+        print('    undoList: empty', file=file)
     else:
-        print('    undoList:')
+        print('    undoList:', file=file)
     for i, undo in enumerate(me.undoList):
-        printIndexedDoItem(i, undo)
+        printIndexedDoItem(i, undo, me.scoreBlobs, file=file)
 
     if not me.redoList:
-        print('    redoList: empty')
+        print('    redoList: empty', file=file)
     else:
-        print('    redoList:')
+        print('    redoList:', file=file)
     for i, redo in enumerate(me.redoList):
-        printIndexedDoItem(i, redo)
-
-def printIndexedDoItem(idx: int, do: dict[str, t.Any]):
-    if 'command' in do and do['command'] == 'restore':
-        score: m21.stream.Score | None = MusicEngineUtilities.thawScore(do['score'])
-        scoreState: ScoreState = do['scoreState']
-        print(f"        {idx}: 'command': 'restore'")
-        print(f"               'score': {scoreString(score)}")
-        print("               'scoreState':")
-        print(f"                   'shoppedAs': '{shoppedAsString(scoreState.shoppedAs)}'")
-        print("                   'shoppedPartRanges': "
-              f"{partRangesString(scoreState.shoppedPartRanges)}")
+        printIndexedDoItem(i, redo, me.scoreBlobs, file=file)
+
+def printIndexedDoItem(
+    idx: int,
+    do: DoItem,
+    scoreBlobs: list[bytes | memoryview],
+    file: t.TextIO | None = None
+):
+    if isinstance(do, RestoreUndo):
+        score: 'm21.stream.Score | None' = None
+        if do.scoreRef is not None:
+            score = MusicEngineUtilities.thawScore(scoreBlobs[do.scoreRef])
+        scoreState: ScoreState = do.scoreState
+        print(f'        {idx}: RestoreUndo', file=file)
+        print(f'               score: {MusicEngineUtilities.scoreLabel(score)}', file=file)
+        print('               scoreState:', file=file)
+        print(f'                   shoppedAs: {shoppedAsString(scoreState.shoppedAs)}', file=file)
+        print('                   shoppedPartRanges: '
+              f'{partRangesString(scoreState.shoppedPartRanges)}', file=file)
     else:
-        print(f'        {idx}: {do}')
-
-def printZippedMeiFile(zippedMei: bytes | None):
-    if zippedMei:
-        print('mei: present')
+        print(f'        {idx}: {do}', file=file)
 
-def printZippedHumdrumFile(zippedHumdrum: bytes | None):
-    if zippedHumdrum:
-        print('humdrum: present')
-
-def printZippedMusicXmlFile(zippedMusicXml: bytes | None):
-    if zippedMusicXml:
-        print('musicxml: present')
+def printRenderings(pickledRenderings: bytes | None, file: t.TextIO | None = None):
+    if not pickledRenderings:
+        return
 
-def scoreString(m21Score: m21.stream.Score | None) -> str:
-    if m21Score is None:
-        return 'No score.'
-    if m21Score.metadata is None:
-        return 'Score with no metadata.'
+    try:
+        renderings: dict[str, bytes] = pickle.loads(pickledRenderings)
+    except Exception as e:
+        print(f'renderings: unpicklable. {e}', file=file)
+        return
 
-    bestTitle: str | None = m21Score.metadata.bestTitle
-    if not bestTitle:
-        return 'Untitled score'
-    return bestTitle
+    for fmt, zippedScore in renderings.items():
+        if zippedScore:
+            print(f'{fmt}: present', file=file)
 
 def partRangesString(partRanges: dict[PartName, VocalRange] | None) -> str:
     if partRanges is None:
         return 'None'
 
-    output: str = ''
-    for i, (part, vrange) in enumerate(partRanges.items()):
-        if i > 0:
-            output += ', '
-        output += part.name + ': ' + str(vrange)
-
-    return output
+    return ', '.join(f'{part.name}: {vrange}' for part, vrange in partRanges.items())
 
 def shoppedAsString(shoppedAs: ArrangementType | None) -> str:
     if shoppedAs is None:
@@ -1,14 +1,55 @@
 # from datetime import datetime
+import os
+import time
+import uuid
 import sqlalchemy as sa
 import sqlalchemy.orm as so
 from app import db
 
+def uuid7() -> uuid.UUID:
+    # A time-ordered (version 7) UUID: 48 bits of Unix time in milliseconds, then
+    # random bits.  New sessions get these, so their primary keys are (roughly)
+    # increasing, and inserts go at the end of the index.  (uuid.uuid7() is only
+    # in Python 3.14 and later.)
+    unixTimeMs: int = time.time_ns() // 1_000_000
+    rand: int = int.from_bytes(os.urandom(10), 'big')
+    value: int = (
+        (unixTimeMs & ((1 << 48) - 1)) << 80
+        | 0x7 << 76                         # version
+        | ((rand >> 62) & 0xFFF) << 64      # rand_a
+        | 0b10 << 62                        # variant
+        | (rand & ((1 << 62) - 1))          # rand_b
+    )
+    return uuid.UUID(int=value)
+
+class BinaryUUID(sa.types.TypeDecorator):
+    # A UUID, stored as BINARY(16).  Accepts uuid.UUID or str (e.g. straight from
+    # the sessionUUID cookie) when binding; always returns uuid.UUID.
+    impl = sa.BINARY(16)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(value)
+        return value.bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return uuid.UUID(bytes=bytes(value))
+
 class AnonymousSession(db.Model):  # type: ignore
-    sessionUUID: so.Mapped[str] = so.mapped_column(sa.String(128), primary_key=True)
+    sessionUUID: so.Mapped[uuid.UUID] = so.mapped_column(BinaryUUID, primary_key=True)
     musicEngine: so.Mapped[bytes | None] = so.mapped_column(db.LargeBinary(length=(2 ** 32) - 1))
-    mei: so.Mapped[bytes | None] = so.mapped_column(db.LargeBinary(length=(2 ** 32) - 1))
-    humdrum: so.Mapped[bytes | None] = so.mapped_column(db.LargeBinary(length=(2 ** 32) - 1))
-    musicxml: so.Mapped[bytes | None] = so.mapped_column(db.LargeBinary(length=(2 ** 32) - 1))
+    # Cached renderings of the musicEngine's score (e.g. 'mei', 'humdrum', 'musicxml'),
+    # as a pickled dict of compressed strings.  Everything in here can be regenerated
+    # from musicEngine.
+    renderings: so.Mapped[bytes | None] = so.mapped_column(db.LargeBinary(length=(2 ** 32) - 1))
+    # A short description of the musicEngine's score (e.g. its title), computed when
+    # musicEngine is stored, so 'flask gdb dump' can list sessions without thawing them.
+    scoreLabel: so.Mapped[str | None] = so.mapped_column(sa.String(256))
 
     def __repr__(self):
         return f'<Anon {self.sessionUUID}>'
@@ -1,8 +1,14 @@
 import typing as t
 # import sys
+import hashlib
+import itertools
+import logging
+import struct
 import zlib
 import pickle
-from copy import deepcopy  # , copy
+import pickletools
+from concurrent.futures import Executor
+from dataclasses import dataclass
 
 import music21 as m21
 
@@ -14,14 +20,92 @@ from app import PartName
 from app import VocalRange
 from app import MusicEngineUtilities
 
-# Register the Humdrum and MEI readers/writers from converter21
-converter21.register()
+logger = logging.getLogger(__name__)
+
+# converter21.register() is not idempotent (every call adds another copy of its
+# subconverters to music21's list of registered subconverters), so only call it once.
+# It is called lazily, just before the first parse or export, so processes that never
+# parse or export (e.g. 'flask gdb dump') don't pay for it.
+_converter21Registered: bool = False
+
+def _registerConverter21():
+    global _converter21Registered
+    if _converter21Registered:
+        return
+    converter21.register()
+    _converter21Registered = True
+
+# Frozen engines start with this prefix, followed by an uncompressed header (see
+# _HEADER), and then a frame (see MusicEngine._packFrame) containing the zstd-compressed
+# pickle data and the (already compressed) frozen scores.  Engines frozen before the
+# prefix existed are plain zlib-compressed pickle data (no prefix or header); thaw still
+# accepts those.
+FROZEN_ENGINE_MAGIC: bytes = b'ZST1'
+
+# header is: version, hasScore, len(undoList), len(redoList).  It is never compressed,
+# so MusicEngine.peek() can read it without thawing anything.
+_HEADER = struct.Struct('<BBII')
+
+# version 1: the pickle data is zstd-compressed
+FROZEN_ENGINE_VERSION: int = 1
+
+# The engine pickle is small (a few hundred bytes; the frozen scores are already
+# compressed, and stored outside it), so even a high compression level is cheap.
+ENGINE_ZSTD_LEVEL: int = 9
+
+# frame lengths are little-endian uint32
+_FRAME_LENGTH = struct.Struct('<I')
+
+# Out-of-band buffers (see freeze) need pickle protocol 5 or later.
+PICKLE_PROTOCOL: int = max(5, pickle.HIGHEST_PROTOCOL)
+
+# The pickle module uses its C accelerator (_pickle) if it can; if it can't, freeze
+# and thaw will be many times slower, so say so.
+if pickle.Pickler.__module__ != '_pickle':
+    logger.warning('C pickle accelerator (_pickle) not available, freeze/thaw will be slow.')
 
 class ScoreState:
     def __init__(self) -> None:
         self.shoppedAs: ArrangementType | None = None
         self.shoppedPartRanges: dict[PartName, VocalRange] | None = None
 
+    def copy(self) -> 'ScoreState':
+        # A shallow copy is enough (and much cheaper than a deepcopy, which would copy
+        # every Pitch in shoppedPartRanges): these fields are only ever replaced (see
+        # MusicEngine.shopIt), never modified in place.
+        output = ScoreState()
+        output.shoppedAs = self.shoppedAs
+        output.shoppedPartRanges = self.shoppedPartRanges
+        return output
+
+
+# The undoList/redoList items.  These used to be dicts (e.g. {'command': 'transpose',
+# 'semitones': 2}); slotted dataclasses are smaller in memory and in the pickle.
+@dataclass(slots=True)
+class TransposeUndo:
+    semitones: int
+
+
+@dataclass(slots=True)
+class ChordOptionUndo:
+    optionId: str
+
+
+@dataclass(slots=True)
+class VisibilityUndo:
+    # True means hide the chord options, False means show them
+    hide: bool
+
+
+@dataclass(slots=True)
+class RestoreUndo:
+    # scoreRef is an index into MusicEngine.scoreBlobs (None means no score)
+    scoreRef: int | None
+    scoreState: ScoreState
+
+
+DoItem = TransposeUndo | ChordOptionUndo | VisibilityUndo | RestoreUndo
+
 
 class MusicEngine:
     def __init__(self) -> None:
@@ -29,42 +113,281 @@ class MusicEngine:
         self.scoreState: ScoreState = ScoreState()
 
         # undoList is a list of commands that will back out recent changes
-        self.undoList: list[dict[str, t.Any]] = []
+        self.undoList: list[DoItem] = []
 
         # redoList is a list of commands that will redo recent undoes.
-        self.redoList: list[dict[str, t.Any]] = []
+        self.redoList: list[DoItem] = []
+
+        # scoreBlobs holds the frozen scores for the RestoreUndo items in undoList
+        # and redoList (which refer to them by index, as scoreRef).  That way each
+        # frozen score is stored only once, and freeze() can keep them out of the
+        # (compressed) pickle data, since they are already compressed.
+        self.scoreBlobs: list[bytes | memoryview] = []
+
+        # _scoreBlobIndex maps the digest (see _scoreBlobDigest) of each of scoreBlobs
+        # to its index, so _addScoreBlob can find a duplicate without comparing whole
+        # frozen scores.  None means it needs to be (re)built from scoreBlobs.
+        self._scoreBlobIndex: dict[bytes, int] | None = None
+
+        # If True, freeze() runs pickletools.optimize on the pickle (drops unused
+        # memo PUTs).  Costs a little CPU at freeze time, but the undo/redo lists
+        # are small, and the smaller pickle is faster to compress and unpickle.
+        self._optimizePickle: bool = True
+
+        # _scoreVersion is bumped every time m21Score is modified (or replaced), and
+        # _frozenScoreCache holds the most recent freezeScore output, along with the
+        # _scoreVersion it was computed for.  See _frozenScore().
+        self._scoreVersion: int = 0
+        self._frozenScoreCache: tuple[int, bytes | memoryview | None] | None = None
+
+        # the _scoreVersion as of the last assureAllXmlIdsAndIds() (-1 means never)
+        self._xmlIdsVersion: int = -1
+
+        # revision is bumped every time anything that freeze() stores is modified,
+        # and _frozenRevision is the revision as of the last freeze() (or thaw()).
+        # -1 means never frozen (or thawed).  See isModified().
+        self.revision: int = 0
+        self._frozenRevision: int = -1
+
+    def isModified(self) -> bool:
+        # True if freeze() would store something different from the last freeze()
+        # (or thaw()), or if there was no last freeze() (or thaw()).
+        return self.revision != self._frozenRevision
+
+    def markModified(self):
+        # Makes isModified() True without changing anything, for an engine that is
+        # going to be stored somewhere other than where it was thawed from.
+        self.revision += 1
 
     def freeze(self) -> bytes:
         storage: dict[str, t.Any] = {}
         if self.m21Score is not None:
-            storage['m21Score'] = MusicEngineUtilities.freezeScore(self.m21Score)
+            frozenScore: bytes | memoryview | None = self._frozenScore()
+            if frozenScore is not None:
+                # The frozen score is by far the biggest thing in here; pass it
+                # out-of-band so pickle doesn't copy it into the pickle stream.
+                storage['m21Score'] = pickle.PickleBuffer(frozenScore)
+        self._compactScoreBlobs()
+        storage['scoreBlobs'] = [pickle.PickleBuffer(blob) for blob in self.scoreBlobs]
         storage['scoreState'] = self.scoreState
         storage['undoList'] = self.undoList
         storage['redoList'] = self.redoList
-        output: bytes = pickle.dumps(storage)
-        output = zlib.compress(output)
+
+        buffers: list[pickle.PickleBuffer] = []
+        pkl: bytes = pickle.dumps(
+            storage, protocol=PICKLE_PROTOCOL, buffer_callback=buffers.append
+        )
+        if self._optimizePickle:
+            pkl = pickletools.optimize(pkl)
+        header: bytes = _HEADER.pack(
+            FROZEN_ENGINE_VERSION,
+            'm21Score' in storage,
+            len(self.undoList),
+            len(self.redoList)
+        )
+        output: bytes = (
+            FROZEN_ENGINE_MAGIC
+            + header
+            + self._packFrame(
+                MusicEngineUtilities.zstdCompress(pkl, level=ENGINE_ZSTD_LEVEL),
+                buffers
+            )
+        )
+        self._frozenRevision = self.revision
         return output
 
+    @staticmethod
+    def peek(frozenEngine: bytes) -> dict[str, t.Any] | None:
+        # Returns the header info from frozenEngine, without thawing it, or None
+        # if there is no header (i.e. frozenEngine is a legacy frozen engine).
+        if frozenEngine[:len(FROZEN_ENGINE_MAGIC)] != FROZEN_ENGINE_MAGIC:
+            return None
+        if len(frozenEngine) < len(FROZEN_ENGINE_MAGIC) + _HEADER.size:
+            return None
+
+        version: int
+        hasScore: int
+        undoCount: int
+        redoCount: int
+        version, hasScore, undoCount, redoCount = (
+            _HEADER.unpack_from(frozenEngine, len(FROZEN_ENGINE_MAGIC))
+        )
+        return {
+            'version': version,
+            'hasScore': bool(hasScore),
+            'undoCount': undoCount,
+            'redoCount': redoCount
+        }
+
+    @staticmethod
+    def _packFrame(zPkl: bytes, buffers: list[pickle.PickleBuffer]) -> bytes:
+        # frame is: compressed pickle length, compressed pickle, then (length, bytes)
+        # for each out-of-band buffer (the frozen scores, which are already compressed).
+        chunks: list[bytes | memoryview] = [_FRAME_LENGTH.pack(len(zPkl)), zPkl]
+        for buffer in buffers:
+            raw: memoryview = buffer.raw()
+            chunks.append(_FRAME_LENGTH.pack(raw.nbytes))
+            chunks.append(raw)
+        return b''.join(chunks)
+
+    @staticmethod
+    def _unpackFrame(frame: bytes | memoryview) -> tuple[memoryview, list[memoryview]]:
+        # Everything returned is a view into frame (nothing is copied).
+        view = memoryview(frame)
+        zPklLength: int = _FRAME_LENGTH.unpack_from(view, 0)[0]
+        pos: int = _FRAME_LENGTH.size
+        zPkl: memoryview = view[pos:pos + zPklLength]
+        pos += zPklLength
+
+        buffers: list[memoryview] = []
+        while pos < len(view):
+            bufLength: int = _FRAME_LENGTH.unpack_from(view, pos)[0]
+            pos += _FRAME_LENGTH.size
+            buffers.append(view[pos:pos + bufLength])
+            pos += bufLength
+        return zPkl, buffers
+
+    @staticmethod
+    def _scoreBlobDigest(frozenScore: bytes | memoryview) -> bytes:
+        return hashlib.blake2b(frozenScore, digest_size=16).digest()
+
+    def _addScoreBlob(self, frozenScore: bytes | memoryview | None) -> int | None:
+        # returns the scoreRef for frozenScore (None if frozenScore is None)
+        if frozenScore is None:
+            return None
+        if self._scoreBlobIndex is None:
+            self._scoreBlobIndex = {}
+            for i, blob in enumerate(self.scoreBlobs):
+                self._scoreBlobIndex.setdefault(self._scoreBlobDigest(blob), i)
+        digest: bytes = self._scoreBlobDigest(frozenScore)
+        ref: int | None = self._scoreBlobIndex.get(digest)
+        if ref is not None:
+            return ref
+        self.scoreBlobs.append(frozenScore)
+        self._scoreBlobIndex[digest] = len(self.scoreBlobs) - 1
+        return len(self.scoreBlobs) - 1
+
+    def _compactScoreBlobs(self):
+        # Drops any scoreBlobs that are no longer referenced by undoList/redoList
+        # (and renumbers the remaining scoreRefs to match).
+        compacted: list[bytes | memoryview] = []
+        newRefs: dict[int, int] = {}
+        for doItem in itertools.chain(self.undoList, self.redoList):
+            if not isinstance(doItem, RestoreUndo) or doItem.scoreRef is None:
+                continue
+            ref: int = doItem.scoreRef
+            if ref not in newRefs:
+                newRefs[ref] = len(compacted)
+                compacted.append(self.scoreBlobs[ref])
+            doItem.scoreRef = newRefs[ref]
+        self.scoreBlobs = compacted
+        if self._scoreBlobIndex is not None:
+            self._scoreBlobIndex = {
+                digest: newRefs[ref]
+                for digest, ref in self._scoreBlobIndex.items()
+                if ref in newRefs
+            }
+
+    def _upgradeLegacyDoItems(self):
+        # Older frozen engines stored undo/redo items as dicts (and even older ones
+        # stored the frozen score right in each 'restore' dict); convert those.
+        for doList in (self.undoList, self.redoList):
+            for i, doItem in enumerate(doList):
+                if isinstance(doItem, dict):
+                    doList[i] = self._upgradeLegacyDoItem(doItem)
+
+    def _upgradeLegacyDoItem(self, doItem: dict[str, t.Any]) -> DoItem:
+        command: str = doItem['command']
+        if command == 'restore':
+            scoreRef: int | None
+            if 'score' in doItem:
+                scoreRef = self._addScoreBlob(doItem['score'])
+            else:
+                scoreRef = doItem['scoreRef']
+            return RestoreUndo(scoreRef, doItem['scoreState'])
+        if command == 'transpose':
+            return TransposeUndo(doItem['semitones'])
+        if command == 'chooseChordOption':
+            return ChordOptionUndo(doItem['optionId'])
+        if command in ('hideChordOptions', 'showChordOptions'):
+            return VisibilityUndo(hide=command == 'hideChordOptions')
+        raise MusicEngineException(f'Unrecognized undo/redo command: {command}')
+
     @classmethod
     def thaw(cls, frozenEngine: bytes):
+        header: dict[str, t.Any] | None = cls.peek(frozenEngine)
+        if header is not None and not header['hasScore']:
+            # nothing else gets restored if there is no score, so skip the
+            # decompress/unpickle entirely.
+            emptyMe = cls()
+            emptyMe._frozenRevision = emptyMe.revision
+            return emptyMe
+
         try:
-            uncompressed: bytes = zlib.decompress(frozenEngine)
-            storage: dict[str, t.Any] = pickle.loads(uncompressed)
+            storage: dict[str, t.Any]
+            if header is not None:
+                zPkl: memoryview
+                buffers: list[memoryview]
+                zPkl, buffers = cls._unpackFrame(
+                    memoryview(frozenEngine)[len(FROZEN_ENGINE_MAGIC) + _HEADER.size:]
+                )
+                if header['version'] != FROZEN_ENGINE_VERSION:
+                    raise MusicEngineException(
+                        f'unsupported frozen engine version: {header["version"]}'
+                    )
+                storage = pickle.loads(
+                    MusicEngineUtilities.zstdDecompress(zPkl), buffers=buffers
+                )
+            else:
+                # legacy (zlib) frozen engine
+                storage = pickle.loads(zlib.decompress(frozenEngine))
         except Exception as e:
-            print(f'thaw failed: {e}')
+            logger.warning('thaw failed: %s', e)
             return None
 
         me = cls()
         if 'm21Score' in storage and storage['m21Score']:
             me.m21Score = MusicEngineUtilities.thawScore(storage['m21Score'])
+            # we already have the frozen bytes for this score, no need to refreeze it
+            me._frozenScoreCache = (me._scoreVersion, storage['m21Score'])
             me.scoreState = storage['scoreState']
+            me.scoreBlobs = storage.get('scoreBlobs', [])
             me.undoList = storage['undoList']
             me.redoList = storage['redoList']
+            me._upgradeLegacyDoItems()
 
+        me._frozenRevision = me.revision
         return me
 
+    def _scoreChanged(self):
+        # must be called after every modification (or replacement) of self.m21Score
+        self._scoreVersion += 1
+        self.revision += 1
+
+    def assureAllXmlIdsAndIds(self):
+        # M21Utilities.assureAllXmlIdsAndIds(self.m21Score), but only walks the score
+        # if it has changed since the last time (e.g. not for an undo with nothing to
+        # undo, or a 0-semitone transpose, on an engine reused from a previous request).
+        if self.m21Score is None or self._xmlIdsVersion == self._scoreVersion:
+            return
+        converter21.M21Utilities.assureAllXmlIdsAndIds(self.m21Score)
+        self._xmlIdsVersion = self._scoreVersion
+
+    def _frozenScore(self) -> bytes | memoryview | None:
+        # Returns MusicEngineUtilities.freezeScore(self.m21Score), but only actually
+        # freezes the score if it has changed since the last time we froze it.
+        if self._frozenScoreCache is not None:
+            version, frozenScore = self._frozenScoreCache
+            if version == self._scoreVersion:
+                return frozenScore
+
+        frozenScore = MusicEngineUtilities.freezeScore(self.m21Score)
+        self._frozenScoreCache = (self._scoreVersion, frozenScore)
+        return frozenScore
+
     @classmethod
-    def fromFileData(cls, fileData: str | bytes, fileName: str):
+    def fromFileData(cls, fileData: str | bytes | t.IO[bytes], fileName: str):
+        _registerConverter21()
         m21Score: m21.stream.Score = MusicEngineUtilities.toMusic21Score(fileData, fileName)
         me = cls()
         me.m21Score = m21Score
@@ -72,16 +395,19 @@ class MusicEngine:
 
     def toMusicXML(self) -> str:
         if self.m21Score is not None:
+            _registerConverter21()
             return MusicEngineUtilities.toMusicXML(self.m21Score)
         return ''
 
     def toHumdrum(self) -> str:
         if self.m21Score is not None:
+            _registerConverter21()
             return MusicEngineUtilities.toHumdrum(self.m21Score)
         return ''
 
     def toMei(self) -> str:
         if self.m21Score is not None:
+            _registerConverter21()
             return MusicEngineUtilities.toMei(self.m21Score)
         return ''
 
@@ -89,39 +415,53 @@ class MusicEngine:
         if self.m21Score is None:
             raise MusicEngineException('Cannot transpose: there is no score.')
 
+        if semitones == 0:
+            # nothing to do (and nothing to undo), so the engine stays unmodified, and
+            # the caller can reuse everything it had cached for the score
+            return 0
+
         actualSemitones: int = (
             MusicEngineUtilities.transposeInPlace(self.m21Score, semitones, approximate)
         )
+        self._scoreChanged()
 
-        self.undoList.append({
-            'command': 'transpose',
-            'semitones': -actualSemitones
-        })
+        self.undoList.append(TransposeUndo(-actualSemitones))
 
         return actualSemitones
 
-    def shopIt(self, arrType: ArrangementType):
+    def shopIt(self, arrType: ArrangementType, executor: Executor | None = None):
+        # If executor is passed in (e.g. routes.getShopExecutor()'s process pool), the
+        # shopping itself (which can take seconds, all of it holding the GIL) is done
+        # there, by shopFrozenScore.
         if self.m21Score is None:
             return
 
+        # note that we do a freezeScore here so that we can just freeze the undoList
+        # (and scoreBlobs) later without having to treat embedded scores specially.
+        # It's also what we send to the executor.
+        frozenScore: bytes | memoryview | None = self._frozenScore()
+
         # This is too big an operation to undo with a command.  Stash off the whole
         # score to restore in an undo.
-        shopped: m21.stream.Score
+        shopped: m21.stream.Score | None
         partRanges: dict[PartName, VocalRange]
-        shopped, partRanges = MusicEngineUtilities.shopIt(self.m21Score, arrType)
+        if executor is not None and frozenScore is not None:
+            frozenShopped: bytes
+            frozenShopped, partRanges = executor.submit(
+                shopFrozenScore, bytes(frozenScore), arrType
+            ).result()
+            shopped = MusicEngineUtilities.thawScore(frozenShopped)
+            if shopped is None:
+                raise MusicEngineException('Failed to thaw the shopped score')
+        else:
+            shopped, partRanges = MusicEngineUtilities.shopIt(self.m21Score, arrType)
 
-        # note that we do a freezeScore here so that we can just freeze the undoList
-        # later without having to treat embedded scores specially.
-        frozenScore: bytes | None = None
-        if self.m21Score is not None:
-            frozenScore = MusicEngineUtilities.freezeScore(self.m21Score)
-        self.undoList.append({
-            'command': 'restore',
-            'score': frozenScore,
-            'scoreState': deepcopy(self.scoreState)
-        })
+        self.undoList.append(
+            RestoreUndo(self._addScoreBlob(frozenScore), self.scoreState.copy())
+        )
 
         self.m21Score = shopped
+        self._scoreChanged()
         self.scoreState.shoppedAs = arrType
         self.scoreState.shoppedPartRanges = partRanges
 
@@ -135,10 +475,8 @@ class MusicEngine:
         undoOptionId: str = MusicEngineUtilities.chooseChordOption(
             self.m21Score, optionId, self.scoreState.shoppedPartRanges
         )
-        self.undoList.append({
-            'command': 'chooseChordOption',
-            'optionId': undoOptionId
-        })
+        self._scoreChanged()
+        self.undoList.append(ChordOptionUndo(undoOptionId))
 
     def hideChordOptions(self):
         self.showHideChordOptions(hide=True)
@@ -151,90 +489,122 @@ class MusicEngine:
             raise MusicEngineException('Cannot show/hide chord option: there is no score.')
 
         MusicEngineUtilities.showHideChordOptions(self.m21Score, hide)
+        self._scoreChanged()
 
-        undoCommand: str
-        if hide:
-            undoCommand = 'showChordOptions'
+        # undo does the opposite
+        self.undoList.append(VisibilityUndo(hide=not hide))
+
+    def _handleRestore(self, doItem: RestoreUndo) -> DoItem | None:
+        # freeze the current score (for the opposite operation) before replacing it
+        frozenScore: bytes | memoryview | None = None
+        if self.m21Score is not None:
+            frozenScore = self._frozenScore()
+        oldScoreState: ScoreState = self.scoreState.copy()
+        if doItem.scoreRef is None:
+            self.m21Score = None
+            self._scoreChanged()
         else:
-            undoCommand = 'hideChordOptions'
+            restoredScore: bytes | memoryview = self.scoreBlobs[doItem.scoreRef]
+            self.m21Score = MusicEngineUtilities.thawScore(restoredScore)
+            self._scoreChanged()
+            # we already have the frozen bytes for the restored score, so the
+            # next freeze() (or restore) won't need to refreeze it.
+            self._frozenScoreCache = (self._scoreVersion, restoredScore)
+        self.scoreState = doItem.scoreState
+        return RestoreUndo(self._addScoreBlob(frozenScore), oldScoreState)
+
+    def _handleTranspose(self, doItem: TransposeUndo) -> DoItem | None:
+        if self.m21Score is None:
+            return None
+        MusicEngineUtilities.transposeInPlace(
+            self.m21Score, doItem.semitones, approximate=False
+        )
+        self._scoreChanged()
+        return TransposeUndo(-doItem.semitones)
 
-        self.undoList.append({
-            'command': undoCommand,
-        })
+    def _handleChordOption(self, doItem: ChordOptionUndo) -> DoItem | None:
+        if self.m21Score is None:
+            return None
+        if self.scoreState.shoppedPartRanges is None:
+            return None
+
+        undoOptionId: str = MusicEngineUtilities.chooseChordOption(
+            self.m21Score, doItem.optionId, self.scoreState.shoppedPartRanges
+        )
+        self._scoreChanged()
+        return ChordOptionUndo(undoOptionId)
+
+    def _handleVisibility(self, doItem: VisibilityUndo) -> DoItem | None:
+        if self.m21Score is None:
+            return None
 
-    def _undoRedo(self, doList: list[dict[str, t.Any]], otherList: list[dict[str, t.Any]]):
+        MusicEngineUtilities.showHideChordOptions(self.m21Score, doItem.hide)
+        self._scoreChanged()
+        return VisibilityUndo(hide=not doItem.hide)
+
+    # Each handler does doItem, and returns the opposite operation (or None if
+    # there was nothing to do).
+    _doHandlers: dict[type, t.Callable[['MusicEngine', t.Any], DoItem | None]] = {
+        RestoreUndo: _handleRestore,
+        TransposeUndo: _handleTranspose,
+        ChordOptionUndo: _handleChordOption,
+        VisibilityUndo: _handleVisibility,
+    }
+
+    def _undoRedo(self, doList: list[DoItem], otherList: list[DoItem]):
         # doList is the list of things to do (pop off the thing to do from this list)
         # otherList is the list where we append the opposite thing to do (after doing it)
         if not doList:
             # nothing to do
             return
 
-        # get the thing to do
-        doItem: dict[str, t.Any] = doList.pop()
+        # get the thing to do, and do it
+        doItem: DoItem = doList.pop()
+        self.revision += 1
+        oppositeItem: DoItem | None = self._doHandlers[type(doItem)](self, doItem)
 
-        if doItem['command'] == 'restore':
-            oldScore: m21.stream.Score | None = self.m21Score
-            oldScoreState: ScoreState = deepcopy(self.scoreState)
-            if doItem['score'] is None:
-                self.m21Score = None
-            else:
-                self.m21Score = MusicEngineUtilities.thawScore(doItem['score'])
-            self.scoreState = doItem['scoreState']
-            # now append the opposite operation to the other list
-            frozenScore: bytes | None = None
-            if oldScore is not None:
-                frozenScore = MusicEngineUtilities.freezeScore(oldScore)
-            otherList.append({
-                'command': 'restore',
-                'score': frozenScore,
-                'scoreState': oldScoreState,
-            })
-
-        elif doItem['command'] == 'transpose':
-            if self.m21Score is None:
-                return
-            semitones: int = doItem['semitones']
-            MusicEngineUtilities.transposeInPlace(self.m21Score, semitones, approximate=False)
-            # now append the opposite operation to the other list
-            otherList.append({
-                'command': 'transpose',
-                'semitones': -semitones,
-            })
-
-        elif doItem['command'] == 'chooseChordOption':
-            if self.m21Score is None:
-                return
-            if self.scoreState.shoppedPartRanges is None:
-                return
-
-            optionId: str = doItem['optionId']
-            undoOptionId: str = MusicEngineUtilities.chooseChordOption(
-                self.m21Score, optionId, self.scoreState.shoppedPartRanges
-            )
-            # now append the opposite operation to the other list
-            otherList.append({
-                'command': 'chooseChordOption',
-                'optionId': undoOptionId
-            })
-
-        elif doItem['command'] in ('hideChordOptions', 'showChordOptions'):
-            if self.m21Score is None:
-                return
-
-            hide: bool = doItem['command'].startswith('hide')
-            MusicEngineUtilities.showHideChordOptions(self.m21Score, hide)
-            # now append the opposite operation to the other list
-            oppositeCommand: str
-            if hide:
-                oppositeCommand = 'showChordOptions'
-            else:
-                oppositeCommand = 'hideChordOptions'
-            otherList.append({
-                'command': oppositeCommand,
-            })
+        # now append the opposite operation to the other list
+        if oppositeItem is not None:
+            otherList.append(oppositeItem)
 
     def undo(self):
         self._undoRedo(doList=self.undoList, otherList=self.redoList)
 
     def redo(self):
         self._undoRedo(doList=self.redoList, otherList=self.undoList)
+
+
+def renderFrozenEngine(frozenEngine: bytes, fmt: str) -> str:
+    # Thaws frozenEngine and returns its score rendered as fmt ('mei', 'humdrum' or
+    # 'musicxml').  This is a module-level function so it can be run in another
+    # process (see routes.py's _renderExecutor): only the frozen bytes and the
+    # resulting string have to be sent between processes.
+    me: MusicEngine | None = MusicEngine.thaw(frozenEngine)
+    if me is None:
+        return ''
+    if fmt == 'mei':
+        return me.toMei()
+    if fmt == 'humdrum':
+        return me.toHumdrum()
+    if fmt == 'musicxml':
+        return me.toMusicXML()
+    raise MusicEngineException(f'Unrecognized rendering format: {fmt}')
+
+def shopFrozenScore(
+    frozenScore: bytes,
+    arrType: ArrangementType
+) -> tuple[bytes, dict[PartName, VocalRange]]:
+    # MusicEngineUtilities.shopIt, for running in another process (see
+    # MusicEngine.shopIt): takes and returns frozen scores, not m21 Scores.  Like
+    # renderFrozenEngine, it is module-level, so a worker that was started fresh
+    # (not forked) can import it by name.
+    score: m21.stream.Score | None = MusicEngineUtilities.thawScore(frozenScore)
+    if score is None:
+        raise MusicEngineException('Failed to thaw the score to be shopped')
+    shopped: m21.stream.Score
+    partRanges: dict[PartName, VocalRange]
+    shopped, partRanges = MusicEngineUtilities.shopIt(score, arrType)
+    frozenShopped: bytes | None = MusicEngineUtilities.freezeScore(shopped)
+    if frozenShopped is None:
+        raise MusicEngineException('Failed to freeze the shopped score')
+    return frozenShopped, partRanges
@@ -1,22 +1,114 @@
 import typing as t
+import codecs
+import logging
 # import sys
 import pathlib
+import pickle
 import re
+import threading
 import zipfile
+import zlib
 from enum import Enum, IntEnum, auto
-from io import BytesIO
+from io import BytesIO, BufferedReader, RawIOBase
 from copy import copy, deepcopy
 from collections.abc import Sequence
 
+import zstandard as zstd
+
+try:
+    import verovio  # optional: only needed for SVG renderings
+except ImportError:
+    verovio = None
+
 import music21 as m21
 from music21.common.numberTools import OffsetQL, opFrac
 
 from converter21 import M21Utilities
 from converter21 import StreamFreezer, StreamThawer
+from converter21 import HumdrumConverter, MEIConverter
+
+logger = logging.getLogger(__name__)
 
 MAX_INT: int = 9223372036854775807
 MAX_OFFSETQL: OffsetQL = opFrac(MAX_INT)
 
+# zstd compressor/decompressor contexts are not safe to share between threads,
+# so each thread lazily creates (and then reuses) its own.
+_zstdContexts = threading.local()
+
+# zstd's own default; callers that care about speed vs. size pass their own level
+ZSTD_DEFAULT_LEVEL: int = 3
+
+# Every zstd frame starts with these four bytes.  Things we compressed with zlib
+# (before we switched to zstd) start with 0x78, so this is how we tell them apart.
+ZSTD_FRAME_MAGIC: bytes = b'\x28\xb5\x2f\xfd'
+
+# A verovio toolkit is expensive to create (it loads all its fonts), and is not
+# thread-safe, so each thread lazily creates (and then reuses) its own.
+_verovioContexts = threading.local()
+
+# for finding (and replacing) the encoding in an XML declaration (see _extractContents)
+_XML_ENCODING_BYTES_RE = re.compile(br"encoding=[\'\"](\S*?)[\'\"]")
+_XML_ENCODING_RE = re.compile(r"encoding=([\'\"]\S*?[\'\"])")
+
+# Subconverters for the formats we upload/download all the time.  Text in one of these
+# formats is handed straight to its subconverter, instead of going through
+# m21.converter.parse (which first checks whether the string is a file path, a URL,
+# etc, and then searches the registered subconverters for the format).
+_DIRECT_SUBCONVERTERS: dict[str, type[m21.converter.subConverters.SubConverter]] = {
+    'humdrum': HumdrumConverter,
+    'mei': MEIConverter,
+    'musicxml': m21.converter.subConverters.ConverterMusicXML,
+}
+
+
+class _ZstdWriter:
+    # Minimal write-only file object that zstd-compresses everything written to it,
+    # so pickle.Pickler can stream straight into the compressor.
+    def __init__(self, level: int) -> None:
+        self._compressor = (
+            MusicEngineUtilities._zstdCompressor(level).compressobj(size=-1)
+        )
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes | memoryview) -> int:
+        self._chunks.append(self._compressor.compress(data))
+        return len(data)
+
+    def getvalue(self) -> bytes:
+        self._chunks.append(self._compressor.flush())
+        return b''.join(self._chunks)
+
+
+class _ZlibReader(RawIOBase):
+    # Read-only file object that decompresses zlib data as it is read, so
+    # pickle.Unpickler can stream straight out of the decompressor.  (Only needed
+    # for scores frozen before we switched to zstd.)
+    def __init__(self, data: bytes | memoryview) -> None:
+        super().__init__()
+        self._decompressor = zlib.decompressobj()
+        self._data: bytes | memoryview = data
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size: int = len(buffer)
+        output: bytes = b''
+        while not output:
+            if self._decompressor.unconsumed_tail:
+                output = self._decompressor.decompress(
+                    self._decompressor.unconsumed_tail, size
+                )
+            elif self._data:
+                output = self._decompressor.decompress(self._data, size)
+                self._data = b''
+            else:
+                output = self._decompressor.flush()
+                break
+        buffer[:len(output)] = output
+        return len(output)
+
 
 class HiddenTextExpression(m21.base.Music21Object):
     # Necessary because MEI doesn't support hidden text expressions, so we must hide
@@ -265,7 +357,9 @@ class FourNotes(Sequence):
                 elif nPitchName == bass:
                     pass
                 else:
-                    print('n.pitch.name not in availableRoleToPitchNames, why did we use it then?')
+                    logger.warning(
+                        'n.pitch.name not in availableRoleToPitchNames, why did we use it then?'
+                    )
 
         return list(roleToPitchNamesWithoutBass.values())
 
@@ -1159,42 +1253,81 @@ class MusicEngineUtilities:
         return output
 
     @staticmethod
-    def toMusic21Score(fileData: str | bytes, fileName: str) -> m21.stream.Score:
+    def canRenderSvg() -> bool:
+        return verovio is not None
+
+    @staticmethod
+    def meiToSvg(meiStr: str, page: int = 1) -> str:
+        # Returns the page of meiStr, engraved (as SVG) by verovio, or '' if there is
+        # no verovio (see canRenderSvg) or no MEI.
+        if verovio is None or not meiStr:
+            return ''
+        toolkit: t.Any = getattr(_verovioContexts, 'toolkit', None)
+        if toolkit is None:
+            toolkit = verovio.toolkit()
+            _verovioContexts.toolkit = toolkit
+        if not toolkit.loadData(meiStr):
+            return ''
+        return toolkit.renderToSVG(page)
+
+    @staticmethod
+    def toMusic21Score(fileData: str | bytes | t.IO[bytes], fileName: str) -> m21.stream.Score:
         fmt: str = m21.common.findFormatFile(fileName)
-        print(f'toMusicScore(fileName={fileName}): fmt={fmt}')
+        logger.debug('toMusicScore(fileName=%s): fmt=%s', fileName, fmt)
+        if not isinstance(fileData, (str, bytes)):
+            # A (seekable) binary file, e.g. an upload.  A zip file is unzipped straight
+            # from it; anything else has to be read in (and decoded) like any other bytes.
+            isZip: bool = fileData.read(4) == b'PK\x03\x04'
+            fileData.seek(0)
+            if isZip:
+                logger.debug('It\'s a zip file')
+                fileData = MusicEngineUtilities._unzipContents(fileData, fmt)
+            else:
+                fileData = fileData.read()
+
         if isinstance(fileData, bytes):
             if fileData[:4] == b'PK\x03\x04':
                 # it's a zip file (probably .mxl file), extract the contents
-                print('It\'s a zip file')
-                with zipfile.ZipFile(BytesIO(fileData), 'r') as f:
-                    newData: str | bytes = MusicEngineUtilities._extractContents(f, fmt)
-                    if not newData:
-                        raise MusicEngineException('mxl file was corrupt')
-                    fileData = newData
-                pass
+                logger.debug('It\'s a zip file')
+                fileData = MusicEngineUtilities._unzipContents(BytesIO(fileData), fmt)
             else:
                 # Some parsers do this for you, but some do not.
                 # TODO: Here and in converter21's importers,
                 # TODO: support utf-16 as well.
                 try:
-                    print('decoding utf-8')
+                    logger.debug('decoding utf-8')
                     fileData = fileData.decode('utf-8')
                 except UnicodeDecodeError:
                     try:
-                        print('utf-8 failed; decoding latin-1')
+                        logger.debug('utf-8 failed; decoding latin-1')
                         if t.TYPE_CHECKING:
                             assert isinstance(fileData, bytes)
                         fileData = fileData.decode('latin-1')
                     except Exception:
-                        print('couldn\'t decode, trying parse() anyway')
+                        logger.debug('couldn\'t decode, trying parse() anyway')
                         pass  # carry on with fileData as it was
 
-        print(f'toMusicScore: parsing: first 300 bytes of score: {fileData[0:300]!r}')
-        output = m21.converter.parse(fileData, format=fmt, forceSource=True)
+        logger.debug('toMusicScore: parsing: first 300 bytes of score: %r', fileData[0:300])
+        output: m21.stream.Score | m21.stream.Opus
+        subConverterClass = _DIRECT_SUBCONVERTERS.get(fmt)
+        if subConverterClass is not None and isinstance(fileData, str):
+            subConverter = subConverterClass()
+            subConverter.parseData(fileData)
+            output = subConverter.stream
+        else:
+            output = m21.converter.parse(fileData, format=fmt, forceSource=True)
         if t.TYPE_CHECKING:
             assert isinstance(output, m21.stream.Score)
         return output
 
+    @staticmethod
+    def _unzipContents(zipData: t.IO[bytes], dataFormat: str) -> str | bytes:
+        with zipfile.ZipFile(zipData, 'r') as f:
+            contents: str | bytes = MusicEngineUtilities._extractContents(f, dataFormat)
+        if not contents:
+            raise MusicEngineException('mxl file was corrupt')
+        return contents
+
     @staticmethod
     def _extractContents(f: zipfile.ZipFile,
                          dataFormat: str = 'musicxml') -> str | bytes:
@@ -1218,10 +1351,10 @@ class MusicEngineUtilities:
 
                 post = f.read(subFp)
                 if isinstance(post, bytes):
-                    foundEncoding = re.match(br"encoding=[\'\"](\S*?)[\'\"]", post[:1000])
+                    foundEncoding = _XML_ENCODING_BYTES_RE.match(post, 0, 1000)
                     if foundEncoding:
                         defaultEncoding = foundEncoding.group(1).decode('ascii')
-                        print('Found encoding: ', defaultEncoding)
+                        logger.debug('Found encoding: %s', defaultEncoding)
                     else:
                         defaultEncoding = 'UTF-8'
                     try:
@@ -1229,33 +1362,140 @@ class MusicEngineUtilities:
                     except UnicodeDecodeError:  # sometimes windows written...
                         if t.TYPE_CHECKING:
                             assert isinstance(post, bytes)
-                        print('trying utf-16-le')
+                        logger.debug('trying utf-16-le')
                         post = post.decode(encoding='utf-16-le')
-                        post = re.sub(r"encoding=([\'\"]\S*?[\'\"])",
-                                      "encoding='UTF-8'", post)
+                        post = _XML_ENCODING_RE.sub("encoding='UTF-8'", post)
 
                 break
 
         return post
 
+    @staticmethod
+    def _zstdCompressor(level: int) -> zstd.ZstdCompressor:
+        # Each thread keeps one compressor per level.
+        cctxs: dict[int, zstd.ZstdCompressor] | None = getattr(_zstdContexts, 'cctxs', None)
+        if cctxs is None:
+            cctxs = {}
+            _zstdContexts.cctxs = cctxs
+        cctx: zstd.ZstdCompressor | None = cctxs.get(level)
+        if cctx is None:
+            cctx = zstd.ZstdCompressor(level=level, threads=-1)
+            cctxs[level] = cctx
+        return cctx
+
+    @staticmethod
+    def zstdCompress(data: bytes, level: int = ZSTD_DEFAULT_LEVEL) -> bytes:
+        return MusicEngineUtilities._zstdCompressor(level).compress(data)
+
+    @staticmethod
+    def _zstdDecompressor() -> zstd.ZstdDecompressor:
+        dctx: zstd.ZstdDecompressor | None = getattr(_zstdContexts, 'dctx', None)
+        if dctx is None:
+            dctx = zstd.ZstdDecompressor()
+            _zstdContexts.dctx = dctx
+        return dctx
+
+    @staticmethod
+    def zstdDecompress(data: bytes | memoryview) -> bytes:
+        dctx: zstd.ZstdDecompressor = MusicEngineUtilities._zstdDecompressor()
+        if zstd.frame_content_size(data) == -1:
+            # streamed frames (e.g. from zstdCompressString) don't record their
+            # decompressed size, which dctx.decompress needs
+            return dctx.decompressobj().decompress(data)
+        return dctx.decompress(data)
+
+    @staticmethod
+    def zstdCompressString(
+        string: str,
+        level: int = ZSTD_DEFAULT_LEVEL,
+        chunkSize: int = 256 * 1024
+    ) -> bytes:
+        # Same as zstdCompress(string.encode('utf-8')), but encodes and compresses a
+        # chunk at a time, so the whole UTF-8 encoding never exists all at once.
+        cobj = MusicEngineUtilities._zstdCompressor(level).compressobj(size=-1)
+        chunks: list[bytes] = []
+        for start in range(0, len(string), chunkSize):
+            chunks.append(cobj.compress(string[start:start + chunkSize].encode('utf-8')))
+        chunks.append(cobj.flush())
+        return b''.join(chunks)
+
+    @staticmethod
+    def zstdDecompressString(data: bytes | memoryview, chunkSize: int = 256 * 1024) -> str:
+        # Same as zstdDecompress(data).decode('utf-8'), but decompresses and decodes a
+        # chunk at a time, so the whole UTF-8 encoding never exists all at once.
+        dctx: zstd.ZstdDecompressor = MusicEngineUtilities._zstdDecompressor()
+        decoder: codecs.IncrementalDecoder = codecs.getincrementaldecoder('utf-8')()
+        pieces: list[str] = []
+        for chunk in dctx.read_to_iter(data, write_size=chunkSize):
+            pieces.append(decoder.decode(chunk))
+        pieces.append(decoder.decode(b'', final=True))
+        return ''.join(pieces)
+
+    @staticmethod
+    def zlibDecompressString(data: bytes | memoryview, chunkSize: int = 256 * 1024) -> str:
+        # zlib version of zstdDecompressString (for renderings cached before we switched
+        # to zstd)
+        dobj = zlib.decompressobj()
+        decoder: codecs.IncrementalDecoder = codecs.getincrementaldecoder('utf-8')()
+        pieces: list[str] = []
+        chunk: bytes = dobj.decompress(data, chunkSize)
+        while chunk:
+            pieces.append(decoder.decode(chunk))
+            chunk = dobj.decompress(dobj.unconsumed_tail, chunkSize)
+        pieces.append(decoder.decode(b'', final=True))
+        return ''.join(pieces)
+
+    @staticmethod
+    def scoreLabel(score: m21.stream.Score | None) -> str:
+        # a short description of the score (for logging, 'flask gdb dump', etc)
+        if score is None:
+            return 'No score.'
+        if score.metadata is None:
+            return 'Score with no metadata.'
+
+        bestTitle: str | None = score.metadata.bestTitle
+        if not bestTitle:
+            return 'Untitled score'
+        return bestTitle
+
     @staticmethod
     def freezeScore(score: m21.stream.Score | None) -> bytes | None:
         if score is None:
             return None
+        # This is StreamFreezer.write(fmt='pickle', zipType='zlib'), except that it is
+        # compressed with zstd (much faster than zlib, for the same size), and the
+        # pickle data is streamed through the compressor, instead of being pickled
+        # to one big bytes object and then compressed into another.
         sf = StreamFreezer(score)
-        output: str | bytes = sf.write(fmt='pickle', zipType='zlib')
-        if t.TYPE_CHECKING:
-            # because zlib compression returns bytes
-            assert isinstance(output, bytes)
-        return output
+        storage: dict[str, t.Any] = sf.packStream(sf.stream)
+        zfile = _ZstdWriter(ZSTD_DEFAULT_LEVEL)
+        try:
+            pickle.Pickler(zfile).dump(storage)
+        except Exception as e:
+            logger.warning('freezeScore failed: %s', e)
+            return b''
+        return zfile.getvalue()
 
     @staticmethod
-    def thawScore(frozenScore: bytes | None) -> m21.stream.Score | None:
+    def thawScore(frozenScore: bytes | memoryview | None) -> m21.stream.Score | None:
         if frozenScore is None:
             return None
+        # This is StreamThawer.open(frozenScore, zipType='zlib'), except that the pickle
+        # data is streamed out of the decompressor, instead of being decompressed into
+        # one big bytes object first.
         st = StreamThawer()
-        st.open(frozenScore, zipType='zlib')
-        return st.stream
+        try:
+            zfile: t.BinaryIO
+            if bytes(frozenScore[:len(ZSTD_FRAME_MAGIC)]) == ZSTD_FRAME_MAGIC:
+                zfile = MusicEngineUtilities._zstdDecompressor().stream_reader(frozenScore)
+            else:
+                # frozen (with zlib) before we switched to zstd
+                zfile = BufferedReader(_ZlibReader(frozenScore))
+            storage: dict[str, t.Any] = pickle.Unpickler(zfile).load()
+        except Exception as e:
+            logger.warning('thawScore failed: %s', e)
+            return None
+        return st.unpackStream(storage)
 
     @staticmethod
     def showHideChordOptions(score: m21.stream.Score, hide: bool):
@@ -4899,7 +5139,7 @@ class MusicEngineUtilities:
                 f'chosenOption {chosenOption} does not have an associated chord symbol.'
             )
 
-        print(f'chosenOption == {chosenOption}')
+        logger.debug('chosenOption == %s', chosenOption)
 
         container: m21.stream.Stream | None = score.containerInHierarchy(
             chosenOption,
@@ -4950,10 +5190,10 @@ class MusicEngineUtilities:
         if not foundChosenOption:
             raise MusicEngineException('Unexpected failure to find chosenOption in list.')
 
-        print(f'prevOption == {prevOption}')
+        logger.debug('prevOption == %s', prevOption)
 
         prevOptionStr: str = M21Utilities.convertChordSymbolToText(prevOption)
-        print(f'prevOptionStr == {prevOptionStr}')
+        logger.debug('prevOptionStr == %s', prevOptionStr)
 
         csChosen: m21.harmony.ChordSymbol = chosenOption.me_chordsymbol  # type: ignore
         csChosen.quarterLength = prevOption.quarterLength
@@ -1,300 +1,621 @@
 import typing as t
+import gzip
+import hashlib
+import logging
+import multiprocessing
 import uuid
 import zlib
-from io import BytesIO
+import pickle
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 from flask import (
+    Blueprint,
+    Flask,
     Response,
+    current_app,
+    g,
+    has_request_context,
     render_template,
     request,
-    make_response,
-    send_file
+    make_response
 )
 
-from converter21 import M21Utilities
-
-from app import app, db
-from app.models import AnonymousSession
+from app import db, setupWorkerLogging
+from app.models import AnonymousSession, uuid7
 
 from .music_engine_utilities import ArrangementType
+from .music_engine_utilities import MusicEngineUtilities
+from .music_engine_utilities import ZSTD_FRAME_MAGIC
 
 from .music_engine import MusicEngine
+from .music_engine import renderFrozenEngine
+
+logger = logging.getLogger(__name__)
 
+# All the site's routes; registered (once) in app/__init__.py
+bp = Blueprint('main', __name__)
 
 # from app.forms import LoginForm
 
-@app.route('/')
+@bp.route('/')
 def index() -> Response | str:
-    sessionUUID: str | None = request.cookies.get('sessionUUID')
+    sessionUUID: str | None = getCanonicalSessionUUID()
     if not sessionUUID:
-        print('index: no uuid')
+        logger.info('index: no (valid) uuid')
         resp = make_response(render_template('index.html', meiInitialScore=''))
         # create a new database entry for a new anonymous session
-        sessionUUID = str(uuid.uuid4())
+        newUUID: uuid.UUID = uuid7()
+        sessionUUID = str(newUUID)
         createNewAnonymousSession(sessionUUID)
-        # return the sessionUUID as a cookie in the response
+        # return the sessionUUID as a cookie in the response (as just the hex digits;
+        # the dashes of str(newUUID) would only make every request 4 bytes longer)
         # oneMonth: int = 31 * 24 * 3600
         resp.set_cookie(
             'sessionUUID',
-            value=sessionUUID,
+            value=newUUID.hex,
             # max_age=oneMonth,  # commented out so it only lasts as long as the browser session
             secure=True,  # Needs to be False to create a cookie from localhost
             httponly=True
         )
-        print(f'index response: new uuid = {sessionUUID}, no initial score')
+        logger.info('index response: new uuid = %s, no initial score', sessionUUID)
         return resp
 
-    print(f'index: uuid = {sessionUUID}')
+    logger.info('index: uuid = %s', sessionUUID)
     # there is a sessionUUID; respond with the resulting score (mei for now, maybe humdrum later)
     session: AnonymousSession | None = getSession(sessionUUID, create=True)
     if t.TYPE_CHECKING:
         # because create=True will create one (and add to database)
         assert session is not None
 
-    me: MusicEngine | None = getMusicEngineForSession(session, create=True)
-    if t.TYPE_CHECKING:
-        # because create=True will create one (and add to session in database)
-        assert me is not None
-    if me.m21Score is not None:
-        meiStr: str = getMeiScoreForSession(session, me)
-        if meiStr:
-            print(f'index response: uuid = {sessionUUID}, initialScore[:100] = {meiStr[:100]}')
-            return render_template('index.html', meiInitialScore=meiStr)
+    # If the MEI is already cached, that's all we need (no need to thaw the music engine)
+    meiStr: str = getCachedTextScoreForSession('mei', session)
+
+    if not meiStr:
+        me: MusicEngine | None = getMusicEngineForSession(session, create=True)
+        if t.TYPE_CHECKING:
+            # because create=True will create one (and add to session in database)
+            assert me is not None
+        if me.m21Score is not None:
+            meiStr = getMeiScoreForSession(session, me)
+            # we didn't modify me, so the next request can reuse it
+            if session.musicEngine:
+                cacheMusicEngine(sessionUUID, getFrozenEngineDigest(session.musicEngine), me)
+
+    if meiStr:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                'index response: uuid = %s, initialScore[:100] = %s',
+                sessionUUID, meiStr[:100]
+            )
+        else:
+            logger.info('index response: uuid = %s, initialScore', sessionUUID)
+        return render_template('index.html', meiInitialScore=meiStr)
 
     # no score in session
-    print(f'index response: uuid = {sessionUUID}, no initialScore')
+    logger.info('index response: uuid = %s, no initialScore', sessionUUID)
     return render_template('index.html', meiInitialScore='')
 
-@app.route('/command', methods=['POST'])
-def command() -> dict:
-    sessionUUID: str | None = request.cookies.get('sessionUUID')
-    print(f'command: uuid = {sessionUUID}')
+# Endpoints that modify the session.  They hold its lock for the whole request (see
+# lockSessionForRequest), and lock its database row (see getSession).
+SESSION_MODIFYING_ENDPOINTS: frozenset[str] = frozenset(('main.command', 'main.score'))
+
+@bp.before_request
+def loadSession() -> Response | None:
+    # Every endpoint but index works on the session named by the sessionUUID cookie,
+    # so it is looked up (and locked, if need be) here, once, as g.sessionUUID and
+    # g.session.  Returning a response skips the endpoint.
+    if request.endpoint == 'main.index':
+        return None
+    sessionUUID: str | None = getCanonicalSessionUUID()
     if not sessionUUID:
+        logger.info('%s: no (valid) uuid', request.path)
         return produceErrorResult('No sessionUUID!')  # should never happen
-    session: AnonymousSession | None = getSession(sessionUUID)
+    g.sessionUUID = sessionUUID
+    modifying: bool = request.endpoint in SESSION_MODIFYING_ENDPOINTS
+    if modifying:
+        lockSessionForRequest(sessionUUID)
+    session: AnonymousSession | None = getSession(sessionUUID, forUpdate=modifying)
     if session is None:
+        logger.info('%s-%s: No session!', request.path, sessionUUID)
         return produceErrorResult('No session!')  # should never happen
+    g.session = session
+    return None
+
+@bp.route('/command', methods=['POST'])
+def command() -> Response:
+    sessionUUID: str = g.sessionUUID
+    session: AnonymousSession = g.session
+    logger.info('command: uuid = %s', sessionUUID)
 
     me: MusicEngine | None = getMusicEngineForSession(session)
     if me is None or me.m21Score is None:
-        print(f'command-{sessionUUID} response: No score to modify')
+        logger.info('command-%s response: No score to modify', sessionUUID)
         return produceErrorResult('No score to modify')
 
-    result: dict[str, str] = {}
-
     # it's a command (like 'transpose'), maybe with some command-defined parameters
     cmd: str = request.form.get('command', '')
-    print(f'command: uuid = {sessionUUID}, cmd = {cmd}')
-    if cmd == 'transpose':
-        semitonesStr: str = request.form.get('semitones', '')
-        print(f'{cmd}-{sessionUUID}: semitonesStr = {semitonesStr}')
-        if not semitonesStr:
-            print(f'{cmd}-{sessionUUID} response: Invalid transpose (no semitones specified)')
-            return produceErrorResult('Invalid transpose (no semitones specified)')
-
-        semitones: int | None = None
-        try:
-            semitones = int(semitonesStr)
-        except Exception:
-            pass
+    logger.info('command: uuid = %s, cmd = %s', sessionUUID, cmd)
+    commandHandler: CommandHandler | None = COMMAND_HANDLERS.get(cmd)
+    if commandHandler is None:
+        logger.info('command-%s response: Invalid music engine command: %s', sessionUUID, cmd)
+        return produceErrorResult(f'Invalid music engine command: {cmd}')
+
+    return commandHandler(me, session, sessionUUID)
+
+# Command handlers: each one performs its command (with any command-defined parameters
+# from request.form) on me, and returns the response.
+def transposeCommand(me: MusicEngine, session: AnonymousSession, sessionUUID: str) -> Response:
+    cmd: str = 'transpose'
+    semitonesStr: str = request.form.get('semitones', '')
+    logger.info('%s-%s: semitonesStr = %s', cmd, sessionUUID, semitonesStr)
+    if not semitonesStr:
+        logger.info(
+            '%s-%s response: Invalid transpose (no semitones specified)',
+            cmd, sessionUUID
+        )
+        return produceErrorResult('Invalid transpose (no semitones specified)')
 
-        if semitones is None:
-            print(
-                f'{cmd}-{sessionUUID} response: Invalid transpose '
-                f'(invalid semitones: "{semitonesStr}")'
-            )
-            return produceErrorResult(
-                f'Invalid transpose (invalid semitones specified: "{semitonesStr}")'
-            )
+    semitones: int | None = parseSemitones(semitonesStr)
+    if semitones is None:
+        logger.info(
+            '%s-%s response: Invalid transpose (invalid semitones: "%s")',
+            cmd, sessionUUID, semitonesStr
+        )
+        return produceErrorResult(
+            f'Invalid transpose (invalid semitones specified: "{semitonesStr}")'
+        )
 
-        try:
-            print(f'{cmd}-{sessionUUID}: transposing music21 score')
-            me.transposeInPlace(semitones)
-            print(f'{cmd}-{sessionUUID} response: success')
-            result = produceResultScores(me, session)
-        except Exception as e:
-            print(f'{cmd}-{sessionUUID} response: Failed to transpose/export: {e}')
-            return produceErrorResult(f'Failed to transpose/export: {e}')
-
-    elif cmd == 'shopIt':
-        arrangementTypeStr: str = request.form.get('arrangementType', '')
-        print(f'{cmd}-{sessionUUID}: arrangementTypeStr = "{arrangementTypeStr}"')
-        if not arrangementTypeStr:
-            print(f'{cmd}-{sessionUUID} response: Invalid shopIt (no arrangementType specified)')
-            return produceErrorResult('Invalid shopIt (no arrangementType specified)')
-
-        arrType: ArrangementType
-        if arrangementTypeStr == 'UpperVoices':
-            arrType = ArrangementType.UpperVoices
-        elif arrangementTypeStr == 'LowerVoices':
-            arrType = ArrangementType.LowerVoices
-        else:
-            print(
-                f'{cmd}-{sessionUUID} response: Invalid shopIt (invalid arrangementType '
-                f'specified: "{arrangementTypeStr}")'
-            )
-            return produceErrorResult(
-                f'Invalid shopIt (invalid arrangementType specified: "{arrangementTypeStr}")'
-            )
+    try:
+        logger.info('%s-%s: transposing music21 score', cmd, sessionUUID)
+        me.transposeInPlace(semitones)
+        logger.info('%s-%s response: success', cmd, sessionUUID)
+        return produceResultScores(me, session)
+    except Exception as e:
+        logger.warning('%s-%s response: Failed to transpose/export: %s', cmd, sessionUUID, e)
+        return produceErrorResult(f'Failed to transpose/export: {e}')
+
+# the arrangementType values shopIt accepts
+ARRANGEMENT_TYPES: dict[str, ArrangementType] = {
+    'UpperVoices': ArrangementType.UpperVoices,
+    'LowerVoices': ArrangementType.LowerVoices,
+}
+
+def shopItCommand(me: MusicEngine, session: AnonymousSession, sessionUUID: str) -> Response:
+    cmd: str = 'shopIt'
+    arrangementTypeStr: str = request.form.get('arrangementType', '')
+    logger.info('%s-%s: arrangementTypeStr = "%s"', cmd, sessionUUID, arrangementTypeStr)
+    if not arrangementTypeStr:
+        logger.info(
+            '%s-%s response: Invalid shopIt (no arrangementType specified)',
+            cmd, sessionUUID
+        )
+        return produceErrorResult('Invalid shopIt (no arrangementType specified)')
 
-        try:
-            print(f'{cmd}-{sessionUUID} response: Shopping score')
-            me.shopIt(arrType)
-            result = produceResultScores(me, session)
-            print(f'{cmd}-{sessionUUID} response: Success')
-        except Exception as e:
-            print(f'{cmd}-{sessionUUID} response: Failed to shop score: {e}')
-            return produceErrorResult(f'Failed to shop score: {e}')
-
-    elif cmd == 'chooseChordOption':
-        chordOptionId: str | None = request.form.get('chordOptionId')
-        print(f'{cmd}-{sessionUUID}: chordOptionId = "{chordOptionId}"')
-        if not chordOptionId:
-            print(
-                f'{cmd}-{sessionUUID} response: Invalid chooseChordOption '
-                '(no chordOptionId specified)'
-            )
-            return produceErrorResult('Invalid chooseChordOption (no chordOptionId specified)')
+    arrType: ArrangementType | None = ARRANGEMENT_TYPES.get(arrangementTypeStr)
+    if arrType is None:
+        logger.info(
+            '%s-%s response: Invalid shopIt (invalid arrangementType specified: "%s")',
+            cmd, sessionUUID, arrangementTypeStr
+        )
+        return produceErrorResult(
+            f'Invalid shopIt (invalid arrangementType specified: "{arrangementTypeStr}")'
+        )
 
-        # for logging only
-        obj = me.m21Score.getElementById(chordOptionId)
-        if obj is not None and hasattr(obj, 'content'):
-            print(f'{cmd}-{sessionUUID}: chordOption content = "{obj.content}"')
-        else:
-            print(f'{cmd}-{sessionUUID}: chordOption has no content')
-        # end for logging only
+    try:
+        logger.info('%s-%s response: Shopping score', cmd, sessionUUID)
+        me.shopIt(arrType, getShopExecutor())
+        result: Response = produceResultScores(me, session)
+        logger.info('%s-%s response: Success', cmd, sessionUUID)
+        return result
+    except Exception as e:
+        logger.warning('%s-%s response: Failed to shop score: %s', cmd, sessionUUID, e)
+        return produceErrorResult(f'Failed to shop score: {e}')
 
-        try:
-            me.chooseChordOption(chordOptionId)
-            print(f'{cmd}-{sessionUUID} response: success')
-            result = produceResultScores(me, session)
-        except Exception as e:
-            print(f'{cmd}-{sessionUUID} response: Failed to chooseChordOption: {e}')
-            return produceErrorResult(f'Failed to chooseChordOption: {e}')
+def chooseChordOptionCommand(
+    me: MusicEngine,
+    session: AnonymousSession,
+    sessionUUID: str
+) -> Response:
+    cmd: str = 'chooseChordOption'
+    chordOptionId: str | None = request.form.get('chordOptionId')
+    logger.info('%s-%s: chordOptionId = "%s"', cmd, sessionUUID, chordOptionId)
+    if not chordOptionId:
+        logger.info(
+            '%s-%s response: Invalid chooseChordOption (no chordOptionId specified)',
+            cmd, sessionUUID
+        )
+        return produceErrorResult('Invalid chooseChordOption (no chordOptionId specified)')
 
-    elif cmd == 'hideChordOptions':
-        try:
-            print(f'hideChordOptions-{sessionUUID} response: Hiding chord options')
-            me.hideChordOptions()
-            result = produceResultScores(me, session)
-            print(f'hideChordOptions-{sessionUUID} response: Success')
-        except Exception as e:
-            print(f'hideChordOptions-{sessionUUID} response: Failed to hide chord options: {e}')
-            return produceErrorResult(f'Failed to hide chord options: {e}')
+    if not isValidChordOptionId(chordOptionId):
+        logger.info(
+            '%s-%s response: Invalid chooseChordOption (invalid chordOptionId: "%s")',
+            cmd, sessionUUID, chordOptionId
+        )
+        return produceErrorResult(
+            f'Invalid chooseChordOption (invalid chordOptionId specified: "{chordOptionId}")'
+        )
 
-    elif cmd == 'showChordOptions':
-        try:
-            print(f'showChordOptions-{sessionUUID} response: Showing chord options')
-            me.showChordOptions()
-            result = produceResultScores(me, session)
-            print(f'showChordOptions-{sessionUUID} response: Success')
-        except Exception as e:
-            print(f'showChordOptions-{sessionUUID} response: Failed to show chord options: {e}')
-            return produceErrorResult(f'Failed to show chord options: {e}')
+    # for logging only (getElementById searches the whole score, so only
+    # do it if it will actually be logged)
+    if logger.isEnabledFor(logging.DEBUG) and me.m21Score is not None:
+        obj = me.m21Score.getElementById(chordOptionId)
+        if obj is not None and hasattr(obj, 'content'):
+            logger.debug('%s-%s: chordOption content = "%s"', cmd, sessionUUID, obj.content)
+        else:
+            logger.debug('%s-%s: chordOption has no content', cmd, sessionUUID)
+    # end for logging only
 
-    elif cmd == 'undo':
-        try:
-            print(f'undo-{sessionUUID} response: Undoing')
-            me.undo()
-            result = produceResultScores(me, session)
-            print(f'undo-{sessionUUID} response: Success')
-        except Exception as e:
-            print(f'undo-{sessionUUID} response: Failed to undo: {e}')
-            return produceErrorResult(f'Failed to undo: {e}')
+    try:
+        me.chooseChordOption(chordOptionId)
+        logger.info('%s-%s response: success', cmd, sessionUUID)
+        return produceResultScores(me, session)
+    except Exception as e:
+        logger.warning('%s-%s response: Failed to chooseChordOption: %s', cmd, sessionUUID, e)
+        return produceErrorResult(f'Failed to chooseChordOption: {e}')
 
-    elif cmd == 'redo':
-        try:
-            print(f'redo-{sessionUUID} response: Redoing')
-            me.redo()
-            result = produceResultScores(me, session)
-            print(f'redo-{sessionUUID} response: Success')
-        except Exception as e:
-            print(f'redo-{sessionUUID} response: Failed to redo: {e}')
-            return produceErrorResult(f'Failed to redo: {e}')
+def hideChordOptionsCommand(
+    me: MusicEngine,
+    session: AnonymousSession,
+    sessionUUID: str
+) -> Response:
+    try:
+        logger.info('hideChordOptions-%s response: Hiding chord options', sessionUUID)
+        me.hideChordOptions()
+        result: Response = produceResultScores(me, session)
+        logger.info('hideChordOptions-%s response: Success', sessionUUID)
+        return result
+    except Exception as e:
+        logger.warning(
+            'hideChordOptions-%s response: Failed to hide chord options: %s',
+            sessionUUID, e
+        )
+        return produceErrorResult(f'Failed to hide chord options: {e}')
 
-    else:
-        print(f'command-{sessionUUID} response: Invalid music engine command: {cmd}')
-        result = produceErrorResult(f'Invalid music engine command: {cmd}')
+def showChordOptionsCommand(
+    me: MusicEngine,
+    session: AnonymousSession,
+    sessionUUID: str
+) -> Response:
+    try:
+        logger.info('showChordOptions-%s response: Showing chord options', sessionUUID)
+        me.showChordOptions()
+        result: Response = produceResultScores(me, session)
+        logger.info('showChordOptions-%s response: Success', sessionUUID)
+        return result
+    except Exception as e:
+        logger.warning(
+            'showChordOptions-%s response: Failed to show chord options: %s',
+            sessionUUID, e
+        )
+        return produceErrorResult(f'Failed to show chord options: {e}')
 
-    return result
+def undoCommand(me: MusicEngine, session: AnonymousSession, sessionUUID: str) -> Response:
+    try:
+        logger.info('undo-%s response: Undoing', sessionUUID)
+        me.undo()
+        result: Response = produceResultScores(me, session)
+        logger.info('undo-%s response: Success', sessionUUID)
+        return result
+    except Exception as e:
+        logger.warning('undo-%s response: Failed to undo: %s', sessionUUID, e)
+        return produceErrorResult(f'Failed to undo: {e}')
 
-@app.route('/score', methods=['POST'])
-def score() -> dict:
-    sessionUUID: str | None = request.cookies.get('sessionUUID')
-    if not sessionUUID:
-        print('POST /score: no uuid')
-        return produceErrorResult('No sessionUUID!')  # should never happen
-    print(f'POST /score: uuid = {sessionUUID}')
-    session: AnonymousSession | None = getSession(sessionUUID)
-    if session is None:
-        print(f'POST /score-{sessionUUID}: No session!')
-        return produceErrorResult('No session!')  # should never happen
+def redoCommand(me: MusicEngine, session: AnonymousSession, sessionUUID: str) -> Response:
+    try:
+        logger.info('redo-%s response: Redoing', sessionUUID)
+        me.redo()
+        result: Response = produceResultScores(me, session)
+        logger.info('redo-%s response: Success', sessionUUID)
+        return result
+    except Exception as e:
+        logger.warning('redo-%s response: Failed to redo: %s', sessionUUID, e)
+        return produceErrorResult(f'Failed to redo: {e}')
+
+CommandHandler = t.Callable[[MusicEngine, AnonymousSession, str], Response]
+
+# command name (the 'command' form field) -> command handler
+COMMAND_HANDLERS: dict[str, CommandHandler] = {
+    'transpose': transposeCommand,
+    'shopIt': shopItCommand,
+    'chooseChordOption': chooseChordOptionCommand,
+    'hideChordOptions': hideChordOptionsCommand,
+    'showChordOptions': showChordOptionsCommand,
+    'undo': undoCommand,
+    'redo': redoCommand,
+}
+
+@bp.route('/score', methods=['POST'])
+def score() -> Response:
+    sessionUUID: str = g.sessionUUID
+    session: AnonymousSession = g.session
+    logger.info('POST /score: uuid = %s', sessionUUID)
 
     # files in formdata end up in request.files
     # all other formdata entries end up in request.form
     file = request.files['file']
     fileName: str = request.form['filename']
-    fileData: str | bytes = file.read()
-    print(f'POST /score-{sessionUUID}: first 100 bytes of {fileName}: {fileData[0:100]!r}')
-    result: dict[str, str] = {}
+    # werkzeug has already spooled the upload (into memory, or a temporary file if it's
+    # big); parse from there, instead of making another copy of the whole thing.
+    fileStream: t.IO[bytes] = file.stream
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            'POST /score-%s: first 100 bytes of %s: %r',
+            sessionUUID, fileName, fileStream.read(100)
+        )
+        fileStream.seek(0)
+    result: Response
     try:
-        # import into music21
-        print(f'POST /score-{sessionUUID}: parsing {fileName}')
-        me: MusicEngine = MusicEngine.fromFileData(fileData, fileName)
-        print(f'POST /score-{sessionUUID}: parsing successful')
+        uploadKey: bytes = getUploadKey(fileStream, fileName)
+        me: MusicEngine | None = getCachedUpload(uploadKey)
+        if me is not None:
+            logger.info('POST /score-%s: reusing parse of identical %s', sessionUUID, fileName)
+        else:
+            # import into music21
+            logger.info('POST /score-%s: parsing %s', sessionUUID, fileName)
+            me = MusicEngine.fromFileData(fileStream, fileName)
+            logger.info('POST /score-%s: parsing successful', sessionUUID)
         result = produceResultScores(me, session)
+        if session.musicEngine:
+            cacheUpload(uploadKey, session.musicEngine)
     except Exception as e:
-        print(f'POST /score-{sessionUUID}: Exception during parse/write: {e}')
+        logger.warning('POST /score-%s: Exception during parse/write: %s', sessionUUID, e)
         return produceErrorResult(f'Exception during parse/write: {e}')
 
     return result
 
-@app.route('/musicxml', methods=['GET'])
-def musicxml() -> Response | dict:
-    sessionUUID: str | None = request.cookies.get('sessionUUID')
-    if not sessionUUID:
-        return produceErrorResult('No sessionUUID!')  # should never happen
-    session: AnonymousSession | None = getSession(sessionUUID)
-    if session is None:
-        return produceErrorResult('No session!')  # should never happen
-    musicxmlStr: str = getMusicXMLScoreForSession(session)
-    musicxmlBytes: bytes = musicxmlStr.encode('utf-8')
-    return send_file(BytesIO(musicxmlBytes), download_name='Score.musicxml', as_attachment=True)
+@bp.route('/musicxml', methods=['GET'])
+def musicxml() -> Response:
+    return sendRendering('musicxml', g.session, 'Score.musicxml')
+
+@bp.route('/humdrum', methods=['GET'])
+def humdrum() -> Response:
+    return sendRendering('humdrum', g.session, 'Score.krn')
+
+@bp.route('/mei', methods=['GET'])
+def mei() -> Response:
+    return sendRendering('mei', g.session, 'Score.mei')
+
+@bp.route('/svg', methods=['GET'])
+def svg() -> Response:
+    # the first page of the score, engraved by verovio (if it is installed)
+    session: AnonymousSession = g.session
+    if not MusicEngineUtilities.canRenderSvg():
+        resp: Response = produceErrorResult('SVG rendering is not available')
+        resp.status_code = 404
+        return resp
+    # an image for the browser to show, not a file to save
+    return sendRendering('svg', session, 'Score.svg', mimetype=SVG_MIMETYPE, inline=True)
 
-@app.route('/humdrum', methods=['GET'])
-def humdrum() -> Response | dict:
-    sessionUUID: str | None = request.cookies.get('sessionUUID')
-    if not sessionUUID:
-        return produceErrorResult('No sessionUUID!')  # should never happen
-    session: AnonymousSession | None = getSession(sessionUUID)
-    if session is None:
-        return produceErrorResult('No session!')  # should never happen
-    humdrumStr: str = getHumdrumScoreForSession(session)
-    humdrumBytes: bytes = humdrumStr.encode('utf-8')
-    return send_file(BytesIO(humdrumBytes), download_name='Score.krn', as_attachment=True)
+@bp.after_request
+def commitDatabaseChanges(response: Response) -> Response:
+    # The support functions below only modify the database objects; all of a
+    # request's changes are committed here, at once.
+    if not (db.session.new or db.session.dirty or db.session.deleted):
+        return response
 
-@app.route('/mei', methods=['GET'])
-def mei() -> Response | dict:
-    sessionUUID: str | None = request.cookies.get('sessionUUID')
-    if not sessionUUID:
-        return produceErrorResult('No sessionUUID!')  # should never happen
-    session: AnonymousSession | None = getSession(sessionUUID)
-    if session is None:
-        return produceErrorResult('No session!')  # should never happen
+    try:
+        db.session.commit()
+    except Exception as e:
+        logger.warning('commitDatabaseChanges: commit failed: %s', e)
+        db.session.rollback()
+        # Nothing was saved, so the endpoint's response (e.g. the new score) is wrong,
+        # and its background renderings are of a score nobody will ask for.
+        for _sessionUUID, _frozenEngineDigest, _fmt, future in g.get('pendingRenderings', []):
+            future.cancel()
+        errorResponse: Response = produceErrorResult('Failed to save changes!')
+        errorResponse.status_code = 500
+        return errorResponse
+
+    # Now that the new musicEngine is committed, the renderings of it that are
+    # still in progress can be cached when they are done.
+    flaskApp: Flask = current_app._get_current_object()  # type: ignore[attr-defined]
+    for sessionUUID, frozenEngineDigest, fmt, future in g.get('pendingRenderings', []):
+        future.add_done_callback(
+            partial(cacheFinishedRendering, flaskApp, sessionUUID, frozenEngineDigest, fmt)
+        )
+    return response
+
+MEI_MIMETYPE: str = 'application/mei+xml'
+SVG_MIMETYPE: str = 'image/svg+xml'
+
+# Responses of these types (the MEI from a /command or /score, or the index page
+# with the initial score in it) are mostly XML, which compresses very well, so they
+# get compressed (if they're big enough to bother, and the client accepts zstd or
+# gzip).  Downloads (application/octet-stream) and SVGs are not in here: they are
+# compressed (or already were) by sendRendering.
+COMPRESSIBLE_MIMETYPES: frozenset[str] = frozenset(
+    (MEI_MIMETYPE, 'application/json', 'text/html')
+)
 
-    meiStr: str = getMeiScoreForSession(session)
-    meiBytes: bytes = meiStr.encode('utf-8')
-    return send_file(BytesIO(meiBytes), download_name='Score.mei', as_attachment=True)
+@bp.after_request
+def compressResponse(response: Response) -> Response:
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    contentEncoding: str
+    if 'zstd' in request.accept_encodings:
+        contentEncoding = 'zstd'
+    elif 'gzip' in request.accept_encodings:
+        contentEncoding = 'gzip'
+    else:
+        return response
+
+    data: bytes = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+    if contentEncoding == 'zstd':
+        data = MusicEngineUtilities.zstdCompress(data, level=RENDERING_ZSTD_LEVEL)
+    else:
+        data = gzip.compress(
+            data, compresslevel=current_app.config['COMPRESS_GZIP_LEVEL'], mtime=0
+        )
+    response.set_data(data)
+    response.headers['Content-Encoding'] = contentEncoding
+    response.vary.add('Accept-Encoding')
+    return response
 
 # Support functions
+# transposing farther than this (in either direction) is rejected
+MAX_TRANSPOSE_SEMITONES: int = 24
+
+def parseSemitones(semitonesStr: str) -> int | None:
+    # Returns the (optionally signed) integer in semitonesStr, or None if it isn't
+    # one, or is out of range.  Checks the characters (and how many there are) first,
+    # so garbage input is rejected without int() raising (and us catching) an exception.
+    digits: str = semitonesStr[1:] if semitonesStr[:1] in ('+', '-') else semitonesStr
+    if not digits.isdecimal() or len(digits) > 9:
+        return None
+    semitones: int = int(semitonesStr)
+    if not -MAX_TRANSPOSE_SEMITONES <= semitones <= MAX_TRANSPOSE_SEMITONES:
+        return None
+    return semitones
+
+# A chordOptionId is the xml:id of a chord option (e.g. 'dir-zwselbboou'): an XML name,
+# and never a long one.  Anything else is rejected without searching the score for it.
+CHORD_OPTION_ID_RE: re.Pattern[str] = re.compile(r'[^\W\d][\w.\-]{0,127}')
+
+def isValidChordOptionId(chordOptionId: str) -> bool:
+    return CHORD_OPTION_ID_RE.fullmatch(chordOptionId) is not None
+
+def makeDownloadResponse(
+    data: bytes,
+    downloadName: str,
+    mimetype: str = 'application/octet-stream',
+    inline: bool = False
+) -> Response:
+    # Like send_file(BytesIO(data), download_name=downloadName, as_attachment=True),
+    # but the response body is data itself (with Content-Length set), rather than
+    # a file object that gets copied out 8KB at a time.  inline=True (for something
+    # the browser should show, rather than save) is like as_attachment=False.
+    resp = Response(data, mimetype=mimetype)
+    resp.headers.set(
+        'Content-Disposition', 'inline' if inline else 'attachment', filename=downloadName
+    )
+    return resp
+
+def sendRendering(
+    fmt: str,
+    session: AnonymousSession,
+    downloadName: str,
+    mimetype: str = 'application/octet-stream',
+    inline: bool = False
+) -> Response:
+    # Sends the session's fmt rendering as a download (see makeDownloadResponse for
+    # mimetype and inline), or a 304 (Not Modified) if the client already has it.
+    etag: str | None = getRenderingETag(fmt, session)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = sendCompressedRendering(fmt, session, downloadName, mimetype, inline)
+        if resp is None:
+            resp = makeDownloadResponse(
+                getRenderingBytes(fmt, session), downloadName, mimetype, inline
+            )
+    resp.vary.add('Accept-Encoding')
+    if etag is not None:
+        # weak, since the same rendering may be sent with different Content-Encodings
+        resp.set_etag(etag, weak=True)
+        # the rendering at this URL changes with every command, so always revalidate
+        resp.cache_control.no_cache = True
+    return resp
+
+def getRenderingBytes(fmt: str, session: AnonymousSession) -> bytes:
+    # Same as getTextScoreForSession(fmt, session).encode('utf-8'), except that a cached
+    # rendering is decompressed straight to UTF-8, instead of being decoded to a str
+    # and then encoded again.
+    zBytes: bytes | None = getRenderings(session).get(fmt)
+    if zBytes:
+        try:
+            if zBytes[:len(ZSTD_FRAME_MAGIC)] == ZSTD_FRAME_MAGIC:
+                return MusicEngineUtilities.zstdDecompress(zBytes)
+            return zlib.decompress(zBytes)
+        except Exception:
+            pass
+    return getTextScoreForSession(fmt, session).encode('utf-8')
+
+def getRenderingETag(fmt: str, session: AnonymousSession) -> str | None:
+    # A rendering is determined by the frozen engine it was rendered from, so a digest
+    # of that identifies it (without having to render it, or even look at it).
+    if not session.musicEngine:
+        return None
+    return f'{fmt}-{getFrozenEngineDigest(session.musicEngine).hex()}'
+
+def sendCompressedRendering(
+    fmt: str,
+    session: AnonymousSession,
+    downloadName: str,
+    mimetype: str = 'application/octet-stream',
+    inline: bool = False
+) -> Response | None:
+    # If the client accepts zstd, sends session's fmt rendering zstd-compressed: the
+    # cached rendering as is (the browser decompresses it), or, if it isn't cached as
+    # zstd, compressed here.  Returns None if the client doesn't accept zstd, in which
+    # case the caller should send the uncompressed rendering.
+    if 'zstd' not in request.accept_encodings:
+        return None
+    zBytes: bytes | None = getRenderings(session).get(fmt)
+    if not zBytes or zBytes[:len(ZSTD_FRAME_MAGIC)] != ZSTD_FRAME_MAGIC:
+        # not cached, or a legacy zlib rendering (which we don't send as 'deflate':
+        # browsers disagree about whether that means zlib or raw deflate)
+        data: bytes = getRenderingBytes(fmt, session)
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return makeDownloadResponse(data, downloadName, mimetype, inline)
+        zBytes = MusicEngineUtilities.zstdCompress(data, level=RENDERING_ZSTD_LEVEL)
+
+    resp: Response = makeDownloadResponse(zBytes, downloadName, mimetype, inline)
+    resp.headers['Content-Encoding'] = 'zstd'
+    return resp
+
+def getCanonicalSessionUUID() -> str | None:
+    # Returns the request's sessionUUID cookie in canonical (dashed) form, or None if
+    # there isn't one (or it isn't a valid UUID).  The cookie may be either form (we
+    # used to send the dashed form, now just the hex digits), but the session locks
+    # and caches are all keyed by the canonical form, i.e. str(session.sessionUUID).
+    cookie: str | None = request.cookies.get('sessionUUID')
+    if not cookie:
+        return None
+    key: uuid.UUID | None = parseSessionUUID(cookie)
+    if key is None:
+        return None
+    return str(key)
+
+def parseSessionUUID(sessionUUID: str) -> uuid.UUID | None:
+    # returns None if sessionUUID (e.g. from a cookie) isn't a valid UUID
+    try:
+        return uuid.UUID(sessionUUID)
+    except ValueError:
+        return None
+
 def createNewAnonymousSession(sessionUUID: str) -> AnonymousSession:
-    session = AnonymousSession(sessionUUID=sessionUUID)
+    # (committed by commitDatabaseChanges at the end of the request)
+    session = AnonymousSession(sessionUUID=uuid.UUID(sessionUUID))
     db.session.add(session)
-    db.session.commit()
     return session
 
-def getSession(sessionUUID: str, create: bool = False) -> AnonymousSession | None:
-    data: AnonymousSession | None = db.session.get(AnonymousSession, sessionUUID)
+def getSession(
+    sessionUUID: str,
+    create: bool = False,
+    forUpdate: bool = False
+) -> AnonymousSession | None:
+    # forUpdate=True loads the session with SELECT ... FOR UPDATE, so its row stays
+    # locked until the request's transaction ends (commitDatabaseChanges commits it,
+    # or it is rolled back when the request is torn down).  SessionLock only
+    # serializes requests within one process; this serializes the requests of every
+    # worker process.  (SQLite ignores FOR UPDATE, so with SQLite, run one process.)
+    key: uuid.UUID | None = parseSessionUUID(sessionUUID)
+    if key is None:
+        return None
+    data: AnonymousSession | None = db.session.get(
+        AnonymousSession, key, with_for_update=forUpdate
+    )
     if create and data is None:
         data = createNewAnonymousSession(sessionUUID)
 
@@ -305,137 +626,535 @@ def getMusicEngineForSession(
     create: bool = False
 ) -> MusicEngine | None:
     me: MusicEngine | None = None
-    sessionUUID: str = session.sessionUUID
+    sessionUUID: str = str(session.sessionUUID)
     if session.musicEngine is not None:
         frozenEngine: bytes = session.musicEngine
         if frozenEngine:
-            print(f'getMusicEngineForSession-{sessionUUID} thawing musicEngine')
-            me = MusicEngine.thaw(frozenEngine)
+            me = takeCachedMusicEngine(sessionUUID, getFrozenEngineDigest(frozenEngine))
             if me is not None:
-                print(f'getMusicEngineForSession-{sessionUUID} success')
+                logger.info('getMusicEngineForSession-%s reusing cached musicEngine', sessionUUID)
             else:
-                print(f'getMusicEngineForSession-{sessionUUID} failed to thaw musicEngine')
+                logger.info('getMusicEngineForSession-%s thawing musicEngine', sessionUUID)
+                me = MusicEngine.thaw(frozenEngine)
+                if me is not None:
+                    logger.info('getMusicEngineForSession-%s success', sessionUUID)
+                else:
+                    logger.warning(
+                        'getMusicEngineForSession-%s failed to thaw musicEngine',
+                        sessionUUID
+                    )
 
     if create and me is None:
         # nothing in session, make one (and update the database)
-        print(f'getMusicEngineForSession-{sessionUUID} creating an empty musicEngine')
+        logger.info('getMusicEngineForSession-%s creating an empty musicEngine', sessionUUID)
         me = MusicEngine()
         session.musicEngine = me.freeze()
-        db.session.commit()
     return me
 
+def getFrozenEngineDigest(frozenEngine: bytes) -> bytes:
+    # A blake2b digest of frozenEngine, which identifies it (and everything rendered
+    # from it) in the caches below, and in rendering ETags.  A request asks for the
+    # digest of the same frozen engine several times, so the last one is kept in g.
+    if has_request_context():
+        memo: tuple[bytes, bytes] | None = g.get('frozenEngineDigest')
+        if memo is not None and memo[0] is frozenEngine:
+            return memo[1]
+    digest: bytes = hashlib.blake2b(frozenEngine, digest_size=16).digest()
+    if has_request_context():
+        g.frozenEngineDigest = (frozenEngine, digest)
+    return digest
+
+# Recently used (already thawed) music engines, so that back-to-back requests for the
+# same session don't have to thaw the engine again.  Keyed by sessionUUID, and each
+# entry also holds the digest of the frozen engine it matches, so a stale entry (e.g.
+# the session was modified by another worker process) is never used.
+# A request takes the engine out of the cache while it is using it (it goes back in
+# when the request is done with it), so concurrent requests never share (and modify)
+# the same engine, and an engine left half-modified by a failed command is never reused.
+MUSIC_ENGINE_CACHE_SIZE: int = 64
+_musicEngineCache: OrderedDict[str, tuple[bytes, MusicEngine]] = OrderedDict()
+_musicEngineCacheLock = threading.Lock()
+
+def takeCachedMusicEngine(sessionUUID: str, frozenEngineDigest: bytes) -> MusicEngine | None:
+    with _musicEngineCacheLock:
+        entry: tuple[bytes, MusicEngine] | None = _musicEngineCache.pop(sessionUUID, None)
+    if entry is None or entry[0] != frozenEngineDigest:
+        return None
+    return entry[1]
+
+def cacheMusicEngine(sessionUUID: str, frozenEngineDigest: bytes, me: MusicEngine):
+    # me must match the frozen engine with digest frozenEngineDigest (see
+    # getFrozenEngineDigest), and the caller must not modify me after this.
+    with _musicEngineCacheLock:
+        _musicEngineCache[sessionUUID] = (frozenEngineDigest, me)
+        _musicEngineCache.move_to_end(sessionUUID)
+        while len(_musicEngineCache) > MUSIC_ENGINE_CACHE_SIZE:
+            _musicEngineCache.popitem(last=False)
+
+# Recently uploaded files (keyed by a hash of the file name and contents) and their
+# frozen engines (as of just after the upload), so that uploading the same file again
+# (e.g. starting over, or the same file in another tab) thaws the engine instead of
+# parsing the file again.
+UPLOAD_CACHE_SIZE: int = 16
+_uploadCache: OrderedDict[bytes, bytes] = OrderedDict()
+_uploadCacheLock = threading.Lock()
+
+def getUploadKey(fileStream: t.IO[bytes], fileName: str) -> bytes:
+    # the file name matters too, since its extension picks the parser
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(fileName.encode('utf-8'))
+    hasher.update(b'\0')
+    for chunk in iter(partial(fileStream.read, 256 * 1024), b''):
+        hasher.update(chunk)
+    fileStream.seek(0)
+    return hasher.digest()
+
+def getCachedUpload(uploadKey: bytes) -> MusicEngine | None:
+    with _uploadCacheLock:
+        frozenEngine: bytes | None = _uploadCache.get(uploadKey)
+        if frozenEngine is not None:
+            _uploadCache.move_to_end(uploadKey)
+    if frozenEngine is None:
+        return None
+    me: MusicEngine | None = MusicEngine.thaw(frozenEngine)
+    if me is None or me.m21Score is None:
+        return None
+    # me was thawed from the cache, not from the session it will be stored in
+    me.markModified()
+    return me
+
+def cacheUpload(uploadKey: bytes, frozenEngine: bytes):
+    with _uploadCacheLock:
+        _uploadCache[uploadKey] = frozenEngine
+        _uploadCache.move_to_end(uploadKey)
+        while len(_uploadCache) > UPLOAD_CACHE_SIZE:
+            _uploadCache.popitem(last=False)
+
+# Cache fills (compressing a rendering and storing it in the database) are done
+# on these threads, so the responses don't have to wait for them.
+_cacheFillExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cacheFill')
+
+class SessionLock:
+    # A per-session lock for this process only: requests in other worker processes
+    # are kept out by the session's row lock instead (see getSession's forUpdate).
+    # threading.RLock can't be weakly referenced, so _sessionLocks holds these instead.
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+
+# sessionUUID -> SessionLock, for any session someone is currently holding the lock
+# for (entries go away on their own once nobody references them).
+_sessionLocks: weakref.WeakValueDictionary[str, SessionLock] = weakref.WeakValueDictionary()
+_sessionLocksLock = threading.Lock()
+
+def getSessionLock(sessionUUID: str) -> SessionLock:
+    # Returns the SessionLock for sessionUUID.  Hold on to the returned SessionLock
+    # for as long as you are using it.
+    with _sessionLocksLock:
+        sessionLock: SessionLock | None = _sessionLocks.get(sessionUUID)
+        if sessionLock is None:
+            sessionLock = SessionLock()
+            _sessionLocks[sessionUUID] = sessionLock
+        return sessionLock
+
+def lockSessionForRequest(sessionUUID: str):
+    # Requests that modify a session (commands, uploads) hold its lock from before
+    # they load it until after their changes are committed (see releaseSessionLock),
+    # so they can't both start from the same score and then overwrite each other's
+    # changes.
+    sessionLock: SessionLock = getSessionLock(sessionUUID)
+    sessionLock.lock.acquire()
+    g.heldSessionLock = sessionLock
+
+@bp.teardown_request
+def releaseSessionLock(_exc: BaseException | None):
+    # (runs after commitDatabaseChanges, even if the request failed)
+    sessionLock: SessionLock | None = g.pop('heldSessionLock', None)
+    if sessionLock is not None:
+        sessionLock.lock.release()
+
 def getStringFromCompressedBytes(zBytes: bytes) -> str:
     output: str = ''
     if zBytes:
         try:
-            output = zlib.decompress(zBytes).decode('utf-8')
+            if zBytes[:len(ZSTD_FRAME_MAGIC)] == ZSTD_FRAME_MAGIC:
+                output = MusicEngineUtilities.zstdDecompressString(zBytes)
+            else:
+                output = MusicEngineUtilities.zlibDecompressString(zBytes)
         except Exception:
             pass
     return output
 
-def getCompressedBytesFromString(string: str) -> bytes:
-    return zlib.compress(string.encode('utf-8'))
+# Renderings compressed while a request is waiting (e.g. the MEI in a /command response)
+# use a fast level.  Renderings compressed in the background (see fillRenderingCache)
+# can afford to compress harder, and then take less space (and download faster).
+RENDERING_ZSTD_LEVEL: int = 1
+BACKGROUND_RENDERING_ZSTD_LEVEL: int = 6
 
-def getMeiScoreForSession(session: AnonymousSession, me: MusicEngine | None = None) -> str:
-    output: str = ''
-    if session.mei:
-        output = getStringFromCompressedBytes(session.mei)
-    else:
-        if me is None:
-            me = getMusicEngineForSession(session)
-            if me is None:
-                return output
-        output = me.toMei()
-        session.mei = getCompressedBytesFromString(output)
-        db.session.commit()
-
-    return output
+def getCompressedBytesFromString(string: str, level: int = RENDERING_ZSTD_LEVEL) -> bytes:
+    return MusicEngineUtilities.zstdCompressString(string, level=level)
 
+def getRenderings(session: AnonymousSession) -> dict[str, bytes]:
+    # returns session's cached renderings (format -> compressed string)
+    if not session.renderings:
+        return {}
+    try:
+        return pickle.loads(session.renderings)
+    except Exception:
+        return {}
 
-def getHumdrumScoreForSession(session: AnonymousSession, me: MusicEngine | None = None) -> str:
-    output: str = ''
-    if session.humdrum:
-        output = getStringFromCompressedBytes(session.humdrum)
+def storeRenderings(renderings: dict[str, bytes], session: AnonymousSession):
+    if renderings:
+        session.renderings = pickle.dumps(renderings, protocol=pickle.HIGHEST_PROTOCOL)
     else:
-        if me is None:
-            me = getMusicEngineForSession(session)
-            if me is None:
-                return output
-        output = me.toHumdrum()
-        session.humdrum = getCompressedBytesFromString(output)
-        db.session.commit()
+        session.renderings = None
+
+# Recently used renderings, already decompressed (e.g. the MEI for the index page,
+# which is fetched again on every reload).  Keyed by (sessionUUID, frozen engine digest,
+# fmt), so a changed score never finds the old score's renderings here.
+RENDERING_CACHE_SIZE: int = 16
+_renderingCache: OrderedDict[tuple[str, bytes, str], str] = OrderedDict()
+_renderingCacheLock = threading.Lock()
+
+def getRenderingCacheKey(fmt: str, session: AnonymousSession) -> tuple[str, bytes, str] | None:
+    if not session.musicEngine:
+        return None
+    return (str(session.sessionUUID), getFrozenEngineDigest(session.musicEngine), fmt)
+
+def getCachedRendering(key: tuple[str, bytes, str]) -> str | None:
+    with _renderingCacheLock:
+        output: str | None = _renderingCache.get(key)
+        if output is not None:
+            _renderingCache.move_to_end(key)
     return output
 
+def cacheRendering(key: tuple[str, bytes, str], output: str):
+    with _renderingCacheLock:
+        _renderingCache[key] = output
+        _renderingCache.move_to_end(key)
+        while len(_renderingCache) > RENDERING_CACHE_SIZE:
+            _renderingCache.popitem(last=False)
+
+def getCachedTextScoreForSession(fmt: str, session: AnonymousSession) -> str:
+    # Returns session's fmt rendering if it is cached (decompressed in _renderingCache,
+    # or compressed in session.renderings), or '' if it would have to be rendered.
+    key: tuple[str, bytes, str] | None = getRenderingCacheKey(fmt, session)
+    if key is not None and (cachedOutput := getCachedRendering(key)) is not None:
+        return cachedOutput
 
-def getMusicXMLScoreForSession(session: AnonymousSession, me: MusicEngine | None = None) -> str:
     output: str = ''
-    if session.musicxml:
-        output = getStringFromCompressedBytes(session.musicxml)
+    zBytes: bytes | None = getRenderings(session).get(fmt)
+    if zBytes:
+        output = getStringFromCompressedBytes(zBytes)
+    if key is not None and output:
+        cacheRendering(key, output)
+    return output
+
+def getTextScoreForSession(
+    fmt: str,
+    session: AnonymousSession,
+    me: MusicEngine | None = None
+) -> str:
+    # fmt is 'mei', 'humdrum', 'musicxml' or 'svg'
+    output: str = getCachedTextScoreForSession(fmt, session)
+    if output:
+        return output
+
+    key: tuple[str, bytes, str] | None = getRenderingCacheKey(fmt, session)
+    if (pendingOutput := waitForPendingRendering(session, fmt)) is not None:
+        # it was already being rendered in the background (and will be cached when
+        # that's done), so we just waited for it.
+        output = pendingOutput
+    elif fmt == 'svg':
+        # engraved from the MEI (which is usually already cached)
+        output = MusicEngineUtilities.meiToSvg(getTextScoreForSession('mei', session, me))
+        if output:
+            submitRenderingCacheFill(session, fmt, output)
     else:
+        borrowedMe: bool = False
         if me is None:
             me = getMusicEngineForSession(session)
             if me is None:
                 return output
-        output = me.toMusicXML()
-        session.musicxml = getCompressedBytesFromString(output)
-        db.session.commit()
+            borrowedMe = True
+        if fmt == 'mei':
+            output = me.toMei()
+        elif fmt == 'humdrum':
+            output = me.toHumdrum()
+        elif fmt == 'musicxml':
+            output = me.toMusicXML()
+        if borrowedMe and session.musicEngine:
+            # we didn't modify me, so the next request can reuse it
+            cacheMusicEngine(
+                str(session.sessionUUID), getFrozenEngineDigest(session.musicEngine), me
+            )
+        submitRenderingCacheFill(session, fmt, output)
+
+    if key is not None and output:
+        cacheRendering(key, output)
     return output
 
+def submitRenderingCacheFill(session: AnonymousSession, fmt: str, output: str):
+    # Caches output as the session's fmt rendering, without making the response wait
+    # for the compress and database write.
+    if session.musicEngine is not None:
+        _cacheFillExecutor.submit(
+            fillRenderingCache,
+            current_app._get_current_object(),  # type: ignore[attr-defined]
+            str(session.sessionUUID),
+            getFrozenEngineDigest(session.musicEngine),
+            fmt,
+            output
+        )
+
+# Renderings that aren't needed for the response (e.g. the humdrum and musicxml for
+# a modified score) are rendered in these processes (music21 conversion is pure
+# Python, so threads would just fight over the GIL).  shopIt does its shopping here
+# too, for the same reason.  Created on first use, so processes that never render
+# (e.g. 'flask gdb dump') don't start any workers.
+def makeWorkerPool(maxWorkers: int) -> ProcessPoolExecutor:
+    # The workers are started by a forkserver, not forked from this (multi-threaded)
+    # process: a forked worker would inherit locks held by our other threads (and zstd
+    # contexts whose worker threads didn't come along), and could wait on them forever.
+    # The forkserver imports app.music_engine (and so app) once, so each worker doesn't
+    # have to; importing app starts no threads, so the forkserver stays single-threaded.
+    # Each worker's logging is set up by setupWorkerLogging.
+    mpContext = multiprocessing.get_context('forkserver')
+    mpContext.set_forkserver_preload(['app.music_engine'])
+    return ProcessPoolExecutor(
+        max_workers=maxWorkers,
+        mp_context=mpContext,
+        initializer=setupWorkerLogging
+    )
+
+# Background renderings (see startBackgroundRenderings) run here.
+_renderExecutor: ProcessPoolExecutor | None = None
+_renderExecutorLock = threading.Lock()
+
+def getRenderExecutor() -> ProcessPoolExecutor:
+    global _renderExecutor
+    with _renderExecutorLock:
+        if _renderExecutor is None:
+            _renderExecutor = makeWorkerPool(current_app.config['RENDER_WORKERS'])
+        return _renderExecutor
+
+# shopIt's shopping (see shopItCommand) runs here, not in _renderExecutor, so it never
+# waits in line behind background renderings: the user is waiting for the shopping.
+_shopExecutor: ProcessPoolExecutor | None = None
+_shopExecutorLock = threading.Lock()
+
+def getShopExecutor() -> ProcessPoolExecutor:
+    global _shopExecutor
+    with _shopExecutorLock:
+        if _shopExecutor is None:
+            _shopExecutor = makeWorkerPool(current_app.config['SHOP_WORKERS'])
+        return _shopExecutor
+
+def startBackgroundRenderings(session: AnonymousSession, fmts: tuple[str, ...]):
+    # Starts rendering the session's (just stored) musicEngine as each of fmts in
+    # _renderExecutor.  They are cached (see cacheFinishedRendering) once the
+    # request's changes have been committed (see commitDatabaseChanges).  Renderings
+    # of the session's earlier musicEngines that haven't started yet are cancelled,
+    # so a burst of commands doesn't leave a queue of renderings nobody will ask for.
+    frozenEngine: bytes | None = session.musicEngine
+    if not frozenEngine:
+        return
+    sessionUUID: str = str(session.sessionUUID)
+    frozenEngineDigest: bytes = getFrozenEngineDigest(frozenEngine)
+    with _pendingRenderingsLock:
+        earlier: dict[tuple[bytes, str], Future] = _pendingRenderings.pop(sessionUUID, {})
+    for earlierFuture in earlier.values():
+        # (outside the lock, since this calls forgetPendingRendering for it)
+        earlierFuture.cancel()
+
+    if 'pendingRenderings' not in g:
+        g.pendingRenderings = []
+    for fmt in fmts:
+        future: Future = getRenderExecutor().submit(renderFrozenEngine, frozenEngine, fmt)
+        key: tuple[bytes, str] = (frozenEngineDigest, fmt)
+        with _pendingRenderingsLock:
+            _pendingRenderings.setdefault(sessionUUID, {})[key] = future
+        future.add_done_callback(partial(forgetPendingRendering, sessionUUID, key))
+        g.pendingRenderings.append((sessionUUID, frozenEngineDigest, fmt, future))
+
+# sessionUUID -> (frozenEngineDigest, fmt) -> Future, for every background rendering
+# that hasn't finished yet, so a request for one of them (e.g. a download) can wait for
+# it instead of rendering it all over again.
+_pendingRenderings: dict[str, dict[tuple[bytes, str], Future]] = {}
+_pendingRenderingsLock = threading.Lock()
+
+def forgetPendingRendering(sessionUUID: str, key: tuple[bytes, str], future: Future):
+    # done-callback for a _renderExecutor future (also called when it is cancelled)
+    with _pendingRenderingsLock:
+        pending: dict[tuple[bytes, str], Future] | None = _pendingRenderings.get(sessionUUID)
+        if pending is None or pending.get(key) is not future:
+            return
+        del pending[key]
+        if not pending:
+            del _pendingRenderings[sessionUUID]
+
+def waitForPendingRendering(session: AnonymousSession, fmt: str) -> str | None:
+    # If the session's current musicEngine is being rendered as fmt in the background,
+    # waits for that and returns it.  Returns None if not (or if that rendering fails).
+    if not session.musicEngine:
+        return None
+    key: tuple[bytes, str] = (getFrozenEngineDigest(session.musicEngine), fmt)
+    with _pendingRenderingsLock:
+        future: Future | None = _pendingRenderings.get(str(session.sessionUUID), {}).get(key)
+    if future is None:
+        return None
+    try:
+        output: str = future.result()
+    except Exception:
+        return None
+    return output or None
+
+def cacheFinishedRendering(
+    flaskApp: Flask,
+    sessionUUID: str,
+    frozenEngineDigest: bytes,
+    fmt: str,
+    future: Future
+):
+    # done-callback for a _renderExecutor future
+    if future.cancelled():
+        return
+    try:
+        output: str = future.result()
+    except Exception as e:
+        logger.warning('background %s rendering for %s failed: %s', fmt, sessionUUID, e)
+        return
+    if not output:
+        return
+    try:
+        _cacheFillExecutor.submit(
+            fillRenderingCache, flaskApp, sessionUUID, frozenEngineDigest, fmt, output
+        )
+    except RuntimeError:
+        # _cacheFillExecutor has been shut down (we're exiting); just don't cache it
+        pass
+
+def fillRenderingCache(
+    flaskApp: Flask,
+    sessionUUID: str,
+    frozenEngineDigest: bytes,
+    fmt: str,
+    output: str
+):
+    # Runs on a _cacheFillExecutor thread: stores output (rendered from the frozen
+    # engine with digest frozenEngineDigest) as the session's cached fmt rendering.
+    # There's no request (or app) context on this thread, so flaskApp is passed in.
+    sessionLock: SessionLock = getSessionLock(sessionUUID)
+    with flaskApp.app_context(), sessionLock.lock:
+        try:
+            # (locked, so another process can't store a new score between the check
+            # below and our commit)
+            session: AnonymousSession | None = getSession(sessionUUID, forUpdate=True)
+            if session is None or session.musicEngine is None:
+                return
+            if getFrozenEngineDigest(session.musicEngine) != frozenEngineDigest:
+                # the score has changed since output was rendered
+                logger.info(
+                    'fillRenderingCache-%s: score changed, not caching %s',
+                    sessionUUID, fmt
+                )
+                return
+            renderings: dict[str, bytes] = getRenderings(session)
+            renderings[fmt] = getCompressedBytesFromString(
+                output, level=BACKGROUND_RENDERING_ZSTD_LEVEL
+            )
+            storeRenderings(renderings, session)
+            db.session.commit()
+        except Exception as e:
+            logger.warning('fillRenderingCache-%s: failed to cache %s: %s', sessionUUID, fmt, e)
+
+def getMeiScoreForSession(session: AnonymousSession, me: MusicEngine | None = None) -> str:
+    return getTextScoreForSession('mei', session, me)
+
 
 def storeMusicEngineForSession(
     me: MusicEngine,
     session: AnonymousSession,
     clearCachedFormats: bool = True
 ):
-    print('freezing m21Score')
+    if not me.isModified() and session.musicEngine:
+        # nothing has changed since me was thawed from (or frozen to) session, so
+        # there is nothing to freeze, and the cached formats are still good.
+        logger.info('music engine not modified, not freezing')
+        cacheMusicEngine(
+            str(session.sessionUUID), getFrozenEngineDigest(session.musicEngine), me
+        )
+        return
+
+    logger.info('freezing m21Score')
     frozenEngine: bytes = me.freeze()
-    print('done freezing music engine')
+    logger.info('done freezing music engine')
     session.musicEngine = frozenEngine
+    cacheMusicEngine(str(session.sessionUUID), getFrozenEngineDigest(frozenEngine), me)
+    session.scoreLabel = MusicEngineUtilities.scoreLabel(me.m21Score)[:256]
 
     if clearCachedFormats:
         # clear the cached formats of the score
-        session.mei = b''
-        session.humdrum = b''
-        session.musicxml = b''
+        session.renderings = None
+
 
-    db.session.commit()
+def storeTextScoreForSession(fmt: str, scoreStr: str, session: AnonymousSession):
+    renderings: dict[str, bytes] = getRenderings(session)
+    renderings[fmt] = getCompressedBytesFromString(scoreStr)
+    storeRenderings(renderings, session)
+    key: tuple[str, bytes, str] | None = getRenderingCacheKey(fmt, session)
+    if key is not None and scoreStr:
+        cacheRendering(key, scoreStr)
 
 
 def storeMeiScoreForSession(meiStr: str, session: AnonymousSession):
-    session.mei = getCompressedBytesFromString(meiStr)
-    db.session.commit()
+    storeTextScoreForSession('mei', meiStr, session)
 
 
 def storeHumdrumScoreForSession(humdrumStr: str, session: AnonymousSession):
-    session.humdrum = getCompressedBytesFromString(humdrumStr)
-    db.session.commit()
+    storeTextScoreForSession('humdrum', humdrumStr, session)
 
 def storeMusicXMLScoreForSession(musicXMLStr: str, session: AnonymousSession):
-    session.musicxml = getCompressedBytesFromString(musicXMLStr)
-    db.session.commit()
+    storeTextScoreForSession('musicxml', musicXMLStr, session)
 
-def produceResultScores(me: MusicEngine, session: AnonymousSession) -> dict[str, str]:
+def produceResultScores(me: MusicEngine, session: AnonymousSession) -> Response:
     # fill out all the xml:ids that are missing,
     # and copy _all_ xml_id to id (except for voice.id).
     # This is so the m21Score and the MEI score have
     # the same ids no matter what (so clicks on the
     # website will map correctly to m21Score objects).
-    if me.m21Score is not None:
-        M21Utilities.assureAllXmlIdsAndIds(me.m21Score)
-
-        print('producing MEI')
-        meiStr = me.toMei()
-        print('done producing MEI')
+    meiStr: str = ''
+    me.assureAllXmlIdsAndIds()
 
+    modified: bool = me.isModified()
     storeMusicEngineForSession(me, session, clearCachedFormats=True)
-    if meiStr:
-        storeMeiScoreForSession(meiStr, session)
-
-    return {
-        'mei': meiStr
-    }
+    if modified and me.m21Score is not None:
+        # the other formats are rendered (from the frozen engine) in other
+        # processes, while we render the MEI here.
+        startBackgroundRenderings(session, current_app.config['PRERENDER_FORMATS'])
 
-def produceErrorResult(error: str) -> dict[str, str]:
-    return {
+    if me.m21Score is not None:
+        if not modified:
+            # nothing has changed (e.g. undo with nothing to undo), so the session's
+            # cached MEI (if it has one) is still good.
+            meiStr = getMeiScoreForSession(session, me)
+        else:
+            logger.info('producing MEI')
+            meiStr = me.toMei()
+            logger.info('done producing MEI')
+            if meiStr:
+                storeMeiScoreForSession(meiStr, session)
+
+    # The MEI is sent as is (not inside a JSON object), so it doesn't have to be
+    # escaped here and unescaped again in the browser.  Errors are still sent as JSON
+    # (see produceErrorResult); the client tells them apart by Content-Type.
+    return Response(meiStr, mimetype=MEI_MIMETYPE)
+
+def produceErrorResult(error: str) -> Response:
+    return makeJsonResponse({
         'appendToConsole': error
-    }
+    })
+
+def makeJsonResponse(result: dict[str, str]) -> Response:
+    # app.json is an OrjsonProvider, which is several times faster than the stdlib
+    # json module.
+    return current_app.json.response(result)
@@ -6,6 +6,18 @@
 
     async function processResponse(resp) {
         if (resp.ok) {
+            const contentType = resp.headers.get('Content-Type') || '';
+            if (!contentType.startsWith('application/json')) {
+                // a successful command (or upload) responds with just the MEI
+                gScoreMei = await resp.text();
+                if (containsScore(gScoreMei)) {
+                    console.log("rendering score from response")
+                    renderMusic();
+                }
+                return;
+            }
+
+            // anything else is a JSON object
             jsonBody = await resp.json();
             showUser = jsonBody['showUser']  // a string
             // 888 figure out how to display text in template html (document.something = showUser)
@@ -126,32 +138,25 @@
         });
     }
 
-    function htmlDecode(input) {
-        var doc = new DOMParser().parseFromString(input, "text/html");
-        return doc.documentElement.textContent;
-    }
-
-    function handleFiles() {
+    async function handleFiles() {
         // Assumes only one score file (since our HTML only allows one).
         // POSTs to server to be saved for later processing and displays
         // the resulting MEI (from response).
         const selectedFile = this.files[0];
-        const reader = new FileReader();
-        reader.onload = async (e) => {
-            // POST file contents to '/score'
-            // The response will be the MEI equivalent of the score file
-            // contents you POSTed (converted by server, even if what you
-            // POSTed was MEI).
-            const formData = new FormData();
-            formData.append('file', selectedFile);
-            formData.append('filename', selectedFile.name);
-            const resp = await fetch(
-                '/score',
-                {method: 'POST', body: formData }
-            );
-            await processResponse(resp);
-        };
-        reader.readAsBinaryString(selectedFile);
+        // POST file contents to '/score'
+        // The response will be the MEI equivalent of the score file
+        // contents you POSTed (converted by server, even if what you
+        // POSTed was MEI).
+        // The browser streams the file straight from disk into the
+        // multipart body; there's no need to read it in first.
+        const formData = new FormData();
+        formData.append('file', selectedFile);
+        formData.append('filename', selectedFile.name);
+        const resp = await fetch(
+            '/score',
+            {method: 'POST', body: formData }
+        );
+        await processResponse(resp);
     }
 
     function chooseNewChordOption(target) {
@@ -185,7 +190,7 @@
 
     document.addEventListener("DOMContentLoaded", (event) => {
         initialScore = document.getElementById("initialScore");
-        gScoreMei = htmlDecode(initialScore.text.trim())
+        gScoreMei = JSON.parse(initialScore.textContent)
         if (containsScore(gScoreMei)) {
             console.log("loaded initialScore into gScoreMei")
         }
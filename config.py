@@ -7,9 +7,32 @@ load_dotenv(os.path.join(basedir, '.env'))
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'super-secret-you-will-never-guess'
+    # For MySQL, use the mysqlclient (C) driver, i.e. 'mysql+mysqldb://...' (or just
+    # 'mysql://...'), not the much slower pure-Python 'mysql+mysqlconnector://...'.
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
-    SQLALCHEMY_POOL_RECYCLE = 299
+    # (Flask-SQLAlchemy 3 ignores SQLALCHEMY_POOL_RECYCLE; pool_recycle has to go in
+    # here.)  Connections are recycled before MySQL's wait_timeout closes them.
     SQLALCHEMY_ENGINE_OPTIONS = {
         "pool_pre_ping": True,
+        "pool_recycle": 299,
     }
+    # e.g. DEBUG to see the (more expensive) debug logging, or WARNING for less
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
+    # Formats (besides MEI) rendered in the background every time the score changes,
+    # so their downloads are usually already cached.  Set to '' to only render them
+    # when they are actually downloaded.
+    PRERENDER_FORMATS = tuple(
+        fmt for fmt in os.environ.get('PRERENDER_FORMATS', 'humdrum,musicxml').split(',') if fmt
+    )
+    # Responses smaller than this aren't worth compressing (see compressResponse);
+    # gzip (for clients that don't accept zstd) compresses at this level.
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 1024)
+    COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL') or 6)
+    # Background renderings run in a pool of this many worker processes (see
+    # getRenderExecutor), and shopIt in a separate pool of SHOP_WORKERS (see
+    # getShopExecutor), so it never waits behind renderings.  Each worker has its own
+    # copy of music21 (and of whatever score it is working on), so these are capped
+    # here rather than using one per CPU.
+    RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS') or 2)
+    SHOP_WORKERS = int(os.environ.get('SHOP_WORKERS') or 1)
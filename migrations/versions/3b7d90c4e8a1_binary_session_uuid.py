@@ -0,0 +1,102 @@
+"""store anonymous_session.sessionUUID as BINARY(16)
+
+Revision ID: 3b7d90c4e8a1
+Revises: 9c4f2e6d1a37
+Create Date: 2026-10-16 18:20:07.664120
+
+"""
+import uuid
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7d90c4e8a1'
+down_revision = '9c4f2e6d1a37'
+branch_labels = None
+depends_on = None
+
+
+# The existing string keys are converted to their 16 bytes in a new column, which
+# then replaces the old one (and becomes the primary key).  Any row whose key isn't
+# a valid UUID can't be looked up any more, so it is deleted.
+
+def upgrade():
+    with op.batch_alter_table('anonymous_session', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('sessionKey', sa.BINARY(length=16), nullable=True))
+
+    anonymousSession = sa.table(
+        'anonymous_session',
+        sa.column('sessionUUID', sa.String(length=128)),
+        sa.column('sessionKey', sa.BINARY(length=16))
+    )
+    conn = op.get_bind()
+    for (sessionUUID,) in conn.execute(sa.select(anonymousSession.c.sessionUUID)).all():
+        row = anonymousSession.c.sessionUUID == sessionUUID
+        try:
+            key: bytes = uuid.UUID(sessionUUID).bytes
+        except ValueError:
+            conn.execute(anonymousSession.delete().where(row))
+            continue
+        conn.execute(anonymousSession.update().where(row).values(sessionKey=key))
+
+    # (reflect_args, because SQLite doesn't reflect BINARY columns as BINARY)
+    with op.batch_alter_table(
+        'anonymous_session',
+        schema=None,
+        recreate='always',
+        reflect_args=[sa.Column('sessionKey', sa.BINARY(length=16))]
+    ) as batch_op:
+        batch_op.drop_column('sessionUUID')
+        batch_op.alter_column(
+            'sessionKey',
+            new_column_name='sessionUUID',
+            existing_type=sa.BINARY(length=16),
+            nullable=False
+        )
+    with op.batch_alter_table(
+        'anonymous_session',
+        schema=None,
+        reflect_args=[sa.Column('sessionUUID', sa.BINARY(length=16))]
+    ) as batch_op:
+        batch_op.create_primary_key('pk_anonymous_session', ['sessionUUID'])
+
+
+def downgrade():
+    with op.batch_alter_table('anonymous_session', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('sessionString', sa.String(length=128), nullable=True))
+
+    anonymousSession = sa.table(
+        'anonymous_session',
+        sa.column('sessionUUID', sa.BINARY(length=16)),
+        sa.column('sessionString', sa.String(length=128))
+    )
+    conn = op.get_bind()
+    for (key,) in conn.execute(sa.select(anonymousSession.c.sessionUUID)).all():
+        conn.execute(
+            anonymousSession.update()
+            .where(anonymousSession.c.sessionUUID == key)
+            .values(sessionString=str(uuid.UUID(bytes=bytes(key))))
+        )
+
+    # (reflect_args, because SQLite doesn't reflect BINARY columns as BINARY)
+    with op.batch_alter_table(
+        'anonymous_session',
+        schema=None,
+        recreate='always',
+        reflect_args=[sa.Column('sessionString', sa.String(length=128))]
+    ) as batch_op:
+        batch_op.drop_column('sessionUUID')
+        batch_op.alter_column(
+            'sessionString',
+            new_column_name='sessionUUID',
+            existing_type=sa.String(length=128),
+            nullable=False
+        )
+    with op.batch_alter_table(
+        'anonymous_session',
+        schema=None,
+        reflect_args=[sa.Column('sessionUUID', sa.String(length=128))]
+    ) as batch_op:
+        batch_op.create_primary_key('pk_anonymous_session', ['sessionUUID'])
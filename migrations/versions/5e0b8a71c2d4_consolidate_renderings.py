@@ -0,0 +1,38 @@
+"""consolidate cached mei/humdrum/musicxml into renderings
+
+Revision ID: 5e0b8a71c2d4
+Revises: dadc8f63087c
+Create Date: 2026-10-16 10:12:44.118302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e0b8a71c2d4'
+down_revision = 'dadc8f63087c'
+branch_labels = None
+depends_on = None
+
+
+# The mei/humdrum/musicxml columns only ever held cached renderings of the
+# musicEngine's score, so they are dropped rather than converted; the site
+# regenerates (and re-caches) them on demand.
+
+def upgrade():
+    with op.batch_alter_table('anonymous_session', schema=None) as batch_op:
+        batch_op.add_column(
+            sa.Column('renderings', sa.LargeBinary(length=4294967295), nullable=True)
+        )
+        batch_op.drop_column('mei')
+        batch_op.drop_column('humdrum')
+        batch_op.drop_column('musicxml')
+
+
+def downgrade():
+    with op.batch_alter_table('anonymous_session', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('musicxml', sa.LargeBinary(length=4294967295), nullable=True))
+        batch_op.add_column(sa.Column('humdrum', sa.LargeBinary(length=4294967295), nullable=True))
+        batch_op.add_column(sa.Column('mei', sa.LargeBinary(length=4294967295), nullable=True))
+        batch_op.drop_column('renderings')
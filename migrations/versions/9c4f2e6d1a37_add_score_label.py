@@ -0,0 +1,29 @@
+"""add scoreLabel to anonymous_session
+
+Revision ID: 9c4f2e6d1a37
+Revises: 5e0b8a71c2d4
+Create Date: 2026-10-16 14:02:31.507719
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4f2e6d1a37'
+down_revision = '5e0b8a71c2d4'
+branch_labels = None
+depends_on = None
+
+
+# Existing sessions get a NULL scoreLabel; it is filled in the next time their
+# musicEngine is stored ('flask gdb dump' thaws the musicEngine until then).
+
+def upgrade():
+    with op.batch_alter_table('anonymous_session', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('scoreLabel', sa.String(length=256), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('anonymous_session', schema=None) as batch_op:
+        batch_op.drop_column('scoreLabel')
@@ -33,6 +33,13 @@ if __name__ == '__main__':
 
         install_requires=[
             'music21>=9.1',
-            'converter21>=3.1.1'
-        ]
+            'converter21>=3.1.1',
+            'zstandard>=0.22',
+            'orjson>=3.8'
+        ],
+
+        extras_require={
+            # for the /svg (server-side engraving) endpoint
+            'svg': ['verovio>=4.0'],
+        }
     )
@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+
+# pytest setup for the tests in here (run them from the repository root with
+# 'python -m pytest tests').  The app reads its config when it is first imported, so
+# before any test imports it, point it at a throwaway SQLite database (never a real
+# one), and turn off background prerendering (so no render processes get started).
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_dbFd, _dbPath = tempfile.mkstemp(suffix='.db')
+os.close(_dbFd)
+os.environ['DATABASE_URL'] = 'sqlite:///' + _dbPath
+os.environ['PRERENDER_FORMATS'] = ''
+
+collect_ignore = ['testall.py', 'testPillars.py']  # command-line scripts, not tests
+
+def pytest_sessionfinish(session, exitstatus):
+    os.remove(_dbPath)
@@ -0,0 +1,122 @@
+import pickle
+import zlib
+
+import music21 as m21
+from converter21 import StreamFreezer
+
+from app import MusicEngine, MusicEngineUtilities
+from app import ScoreState, TransposeUndo, VisibilityUndo
+from app.music_engine import FROZEN_ENGINE_MAGIC, _HEADER
+
+# Run with 'python -m pytest tests' (see conftest.py).
+
+def makeScore() -> m21.stream.Score:
+    score = m21.stream.Score()
+    part = m21.stream.Part()
+    measure = m21.stream.Measure(number=1)
+    measure.append(m21.meter.TimeSignature('4/4'))
+    for name in ('C4', 'D4', 'E4', 'F4'):
+        measure.append(m21.note.Note(name, quarterLength=1.0))
+    part.append(measure)
+    score.insert(0, part)
+    return score
+
+def makeLeadSheet() -> m21.stream.Score:
+    # a melody with chord symbols, which is what shopIt needs
+    score = m21.stream.Score()
+    score.metadata = m21.metadata.Metadata(title='Test Lead Sheet')
+    part = m21.stream.Part()
+    bars = (
+        ('C', ('C4', 'D4', 'E4', 'F4')),
+        ('G7', ('G4', 'F4', 'D4', 'B3')),
+        ('C', ('C4', 'E4', 'G4', 'C5')),
+    )
+    for number, (figure, names) in enumerate(bars, start=1):
+        measure = m21.stream.Measure(number=number)
+        if number == 1:
+            measure.append(m21.meter.TimeSignature('4/4'))
+        measure.insert(0, m21.harmony.ChordSymbol(figure))
+        for name in names:
+            measure.append(m21.note.Note(name, quarterLength=1.0))
+        part.append(measure)
+    score.insert(0, part)
+    return score
+
+def pitchNames(score: m21.stream.Score | None) -> list[str]:
+    assert score is not None
+    return [p.nameWithOctave for p in score.pitches]
+
+def testFreezeThawRoundTrip():
+    me = MusicEngine()
+    me.m21Score = makeScore()
+    assert me.transposeInPlace(2) == 2
+    me.hideChordOptions()
+
+    frozen: bytes = me.freeze()
+    assert frozen.startswith(FROZEN_ENGINE_MAGIC)
+    assert MusicEngine.peek(frozen) == {
+        'version': 1, 'hasScore': True, 'undoCount': 2, 'redoCount': 0
+    }
+
+    thawed = MusicEngine.thaw(frozen)
+    assert thawed is not None
+    assert not thawed.isModified()
+    assert pitchNames(thawed.m21Score) == ['D4', 'E4', 'F#4', 'G4']
+    assert thawed.undoList == [TransposeUndo(-2), VisibilityUndo(hide=False)]
+
+    thawed.undo()
+    thawed.undo()
+    assert pitchNames(thawed.m21Score) == ['C4', 'D4', 'E4', 'F4']
+    assert len(thawed.redoList) == 2
+
+    # and the undone state survives another round trip
+    again = MusicEngine.thaw(thawed.freeze())
+    assert again is not None
+    assert pitchNames(again.m21Score) == ['C4', 'D4', 'E4', 'F4']
+    assert again.undoList == []
+    assert len(again.redoList) == 2
+
+def testFreezeThawEmptyEngine():
+    frozen: bytes = MusicEngine().freeze()
+    assert MusicEngine.peek(frozen)['hasScore'] is False
+    thawed = MusicEngine.thaw(frozen)
+    assert thawed is not None
+    assert thawed.m21Score is None
+
+def testThawLegacyZlibEngine():
+    # what freeze() wrote before frozen engines had a header: a zlib-compressed
+    # pickle, with the score frozen by StreamFreezer (also zlib), and dict undo items
+    legacy: bytes = zlib.compress(pickle.dumps({
+        'm21Score': StreamFreezer(makeScore()).write(fmt='pickle', zipType='zlib'),
+        'scoreState': ScoreState(),
+        'undoList': [{'command': 'transpose', 'semitones': -2}],
+        'redoList': []
+    }))
+    assert MusicEngine.peek(legacy) is None
+
+    me = MusicEngine.thaw(legacy)
+    assert me is not None
+    assert pitchNames(me.m21Score) == ['C4', 'D4', 'E4', 'F4']
+    assert me.undoList == [TransposeUndo(-2)]
+    me.undo()
+    assert pitchNames(me.m21Score) == ['B-3', 'C4', 'D4', 'E-4']
+
+def testThawRejectsUnknownVersion():
+    me = MusicEngine()
+    me.m21Score = makeScore()
+    frozen = bytearray(me.freeze())
+    version, hasScore, undoCount, redoCount = _HEADER.unpack_from(frozen, len(FROZEN_ENGINE_MAGIC))
+    _HEADER.pack_into(frozen, len(FROZEN_ENGINE_MAGIC), 2, hasScore, undoCount, redoCount)
+    assert MusicEngine.thaw(bytes(frozen)) is None
+
+def testThawRejectsGarbage():
+    assert MusicEngine.thaw(b'not a frozen engine') is None
+
+def testScoreBlobsAreStoredOnce():
+    me = MusicEngine()
+    blob: bytes = MusicEngineUtilities.freezeScore(makeScore())
+    ref = me._addScoreBlob(blob)
+    assert me._addScoreBlob(bytes(blob)) == ref
+    assert me._addScoreBlob(memoryview(blob)) == ref
+    assert me._addScoreBlob(None) is None
+    assert len(me.scoreBlobs) == 1
@@ -0,0 +1,253 @@
+import io
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from flask import g
+
+from app import app, db, routes
+from app import ArrangementType, MusicEngine, MusicEngineUtilities
+from app.models import BinaryUUID, uuid7
+from app.routes import (
+    MEI_MIMETYPE,
+    getCanonicalSessionUUID,
+    getShopExecutor,
+    getSession,
+    isValidChordOptionId,
+    parseSemitones,
+    parseSessionUUID,
+    startBackgroundRenderings
+)
+
+from testMusicEngine import makeLeadSheet, makeScore, pitchNames
+
+# Run with 'python -m pytest tests' (see conftest.py).
+
+@pytest.fixture(autouse=True, scope='module')
+def database():
+    with app.app_context():
+        db.create_all()
+    yield
+
+def testParseSemitones():
+    assert parseSemitones('2') == 2
+    assert parseSemitones('+2') == 2
+    assert parseSemitones('-12') == -12
+    assert parseSemitones('0') == 0
+    assert parseSemitones('24') == 24
+    assert parseSemitones('-24') == -24
+
+def testParseSemitonesRejects():
+    for bad in ('', 'xx', '+', '-', '1.5', '2x', ' 2', '--2', '+-2', '25', '-25', '1' * 5000):
+        assert parseSemitones(bad) is None, bad
+
+def testIsValidChordOptionId():
+    assert isValidChordOptionId('dir-zwselbboou')
+    assert isValidChordOptionId('chordOption-1-2')
+    assert isValidChordOptionId('_a.b')
+
+def testIsValidChordOptionIdRejects():
+    for bad in ('', '1abc', '-abc', 'a b', 'a"b', 'a/b', '<x>', 'a' * 129):
+        assert not isValidChordOptionId(bad), bad
+
+def testUuid7():
+    first: uuid.UUID = uuid7()
+    time.sleep(0.002)
+    second: uuid.UUID = uuid7()
+    for u in (first, second):
+        assert u.version == 7
+        assert u.variant == uuid.RFC_4122
+    # time-ordered (at millisecond resolution), as bytes too (for the BINARY(16) index)
+    assert first < second
+    assert first.bytes < second.bytes
+
+def testBinaryUUID():
+    column = BinaryUUID()
+    u: uuid.UUID = uuid7()
+    assert column.process_bind_param(u, None) == u.bytes
+    assert column.process_bind_param(str(u), None) == u.bytes
+    assert column.process_bind_param(u.hex, None) == u.bytes
+    assert column.process_bind_param(None, None) is None
+    assert column.process_result_value(u.bytes, None) == u
+    assert column.process_result_value(None, None) is None
+
+def testSessionUUIDCookie():
+    u: uuid.UUID = uuid7()
+    assert parseSessionUUID(u.hex) == u
+    assert parseSessionUUID(str(u)) == u
+    assert parseSessionUUID('not-a-uuid') is None
+    for cookie in (u.hex, str(u)):
+        with app.test_request_context(headers={'Cookie': f'sessionUUID={cookie}'}):
+            assert getCanonicalSessionUUID() == str(u)
+    with app.test_request_context(headers={'Cookie': 'sessionUUID=garbage'}):
+        assert getCanonicalSessionUUID() is None
+    with app.test_request_context():
+        assert getCanonicalSessionUUID() is None
+
+def uploadTestScore(client) -> None:
+    client.get('/')  # creates the session (and sets its cookie)
+    me = MusicEngine()
+    me.m21Score = makeScore()
+    fileData: bytes = me.toMusicXML().encode('utf-8')
+    resp = client.post(
+        '/score',
+        data={'file': (io.BytesIO(fileData), 'test.musicxml'), 'filename': 'test.musicxml'},
+        content_type='multipart/form-data'
+    )
+    assert resp.status_code == 200
+    assert resp.mimetype == MEI_MIMETYPE
+
+def testCommandRejectsBadArguments():
+    client = app.test_client()
+    uploadTestScore(client)
+    resp = client.post('/command', data={'command': 'transpose', 'semitones': 'xx'})
+    assert resp.mimetype == 'application/json'
+    assert 'Invalid transpose' in resp.get_json()['appendToConsole']
+    resp = client.post(
+        '/command', data={'command': 'chooseChordOption', 'chordOptionId': '<script>'}
+    )
+    assert resp.mimetype == 'application/json'
+    resp = client.post('/command', data={'command': 'bogus'})
+    assert resp.mimetype == 'application/json'
+
+def testSvgIsSentInline(monkeypatch):
+    # (verovio may not be installed here, so it is faked)
+    monkeypatch.setattr(MusicEngineUtilities, 'canRenderSvg', staticmethod(lambda: True))
+    monkeypatch.setattr(
+        MusicEngineUtilities, 'meiToSvg', staticmethod(lambda meiStr, page=1: '<svg/>')
+    )
+    client = app.test_client()
+    uploadTestScore(client)
+    resp = client.get('/svg', headers={'Accept-Encoding': 'identity'})
+    assert resp.status_code == 200
+    assert resp.mimetype == 'image/svg+xml'
+    assert resp.headers['Content-Disposition'].startswith('inline')
+    assert resp.get_data() == b'<svg/>'
+
+    # other downloads are still attachments
+    resp = client.get('/mei')
+    assert resp.mimetype == 'application/octet-stream'
+    assert resp.headers['Content-Disposition'].startswith('attachment')
+
+def testFailedCommitAnswersWithAnError(monkeypatch):
+    client = app.test_client()
+    uploadTestScore(client)
+    before: bytes = client.get('/mei', headers={'Accept-Encoding': 'identity'}).get_data()
+
+    def failingCommit():
+        raise RuntimeError('database went away')
+
+    with monkeypatch.context() as m:
+        m.setattr(db.session, 'commit', failingCommit)
+        resp = client.post('/command', data={'command': 'transpose', 'semitones': '2'})
+    assert resp.status_code == 500
+    assert resp.mimetype == 'application/json'
+    assert 'Failed to save' in resp.get_json()['appendToConsole']
+
+    # and the transposition wasn't kept
+    after: bytes = client.get('/mei', headers={'Accept-Encoding': 'identity'}).get_data()
+    assert after == before
+
+def testDownloadETagAnd304():
+    client = app.test_client()
+    uploadTestScore(client)
+
+    resp = client.get('/mei', headers={'Accept-Encoding': 'identity'})
+    assert resp.status_code == 200
+    assert resp.headers.get('Content-Encoding') is None
+    assert resp.get_data().startswith(b'<?xml')
+    etag: str = resp.headers['ETag']
+    assert etag.startswith('W/"mei-')
+    assert resp.cache_control.no_cache
+
+    # the client already has it
+    resp = client.get('/mei', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.get_data() == b''
+    assert resp.headers['ETag'] == etag
+
+    # the same score as another format is a different rendering
+    resp = client.get('/humdrum', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+    # changing the score changes the ETag
+    resp = client.post('/command', data={'command': 'transpose', 'semitones': '2'})
+    assert resp.mimetype == MEI_MIMETYPE
+    resp = client.get('/mei', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+def testNewerRenderingsCancelQueuedOnes(monkeypatch):
+    client = app.test_client()
+    uploadTestScore(client)
+    cookie = client.get_cookie('sessionUUID')
+    assert cookie is not None
+
+    # a one-thread "render pool" that is kept busy, so nothing submitted to it starts
+    busy = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    executor.submit(busy.wait)
+    monkeypatch.setattr(routes, '_renderExecutor', executor)
+    try:
+        with app.test_request_context(headers={'Cookie': f'sessionUUID={cookie.value}'}):
+            sessionUUID: str | None = getCanonicalSessionUUID()
+            assert sessionUUID is not None
+            session = getSession(sessionUUID)
+            assert session is not None
+            me = MusicEngine.thaw(session.musicEngine)
+            assert me is not None
+            startBackgroundRenderings(session, ('humdrum', 'musicxml'))
+            earlier = [future for *_key, future in g.pendingRenderings]
+
+            me.transposeInPlace(2)
+            session.musicEngine = me.freeze()
+            startBackgroundRenderings(session, ('humdrum',))
+            newer = g.pendingRenderings[-1][-1]
+
+            assert all(future.cancelled() for future in earlier)
+            assert list(routes._pendingRenderings[sessionUUID].values()) == [newer]
+            db.session.rollback()
+    finally:
+        busy.set()
+        executor.shutdown()
+    assert newer.result()
+    assert sessionUUID not in routes._pendingRenderings
+
+def testShopItInShopPool():
+    # shopIt's shopping is done in its own pool (not behind background renderings),
+    # whose workers must not be forked from this (multi-threaded) process
+    with app.app_context():
+        executor = getShopExecutor()
+        renderExecutor = routes.getRenderExecutor()
+    try:
+        assert executor is not renderExecutor
+        assert executor._mp_context.get_start_method() == 'forkserver'
+
+        inProcess = MusicEngine()
+        inProcess.m21Score = makeLeadSheet()
+        inProcess.shopIt(ArrangementType.LowerVoices)
+
+        pooled = MusicEngine()
+        pooled.m21Score = makeLeadSheet()
+        pooled.shopIt(ArrangementType.LowerVoices, executor)
+
+        assert pooled.scoreState.shoppedAs == ArrangementType.LowerVoices
+        assert pitchNames(pooled.m21Score) == pitchNames(inProcess.m21Score)
+        assert {
+            part: (r.lowest.nameWithOctave, r.highest.nameWithOctave)
+            for part, r in pooled.scoreState.shoppedPartRanges.items()
+        } == {
+            part: (r.lowest.nameWithOctave, r.highest.nameWithOctave)
+            for part, r in inProcess.scoreState.shoppedPartRanges.items()
+        }
+
+        pooled.undo()
+        assert pitchNames(pooled.m21Score) == pitchNames(makeLeadSheet())
+    finally:
+        executor.shutdown()
+        renderExecutor.shutdown()
+        routes._shopExecutor = None
+        routes._renderExecutor = None